@@ -1,10 +1,10 @@
 import os
-import shutil
 import time
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from base.modules.access_checks import has_admin_role
-from base.modules.constants import DB_PATH as path
+from base.modules.db_backup import BackupEngine
+from base.modules.db_maintenance import MaintenanceScheduler
 import logging
 
 logger = logging.getLogger(__name__)
@@ -13,6 +13,23 @@ logger = logging.getLogger(__name__)
 class DatabaseManagementCog(commands.Cog, name="Database Commands"):
   def __init__(self, bot):
     self.bot = bot
+    self.backups = BackupEngine()
+    self.maintenance = MaintenanceScheduler(bot.db, bot.archives)
+    self.maintain_databases.start()
+
+  def cog_unload(self):
+    self.maintain_databases.cancel()
+
+  @tasks.loop(minutes=1)
+  async def maintain_databases(self):
+    try:
+      await self.maintenance.tick()
+    except Exception as e:
+      logger.error(f"{e.__class__.__name__} occurs when maintaining the databases: {e}")
+
+  @maintain_databases.before_loop
+  async def before_maintain_databases(self):
+    await self.bot.wait_until_ready()
 
   async def cog_command_error(self, context, error):
     if hasattr(context.command, "on_error"):
@@ -59,7 +76,7 @@ class DatabaseManagementCog(commands.Cog, name="Database Commands"):
   async def _createtable(self, context, _name, _primary_keys, *args):
     tmp = tuple([v.split("=") for v in args])
     kwargs = {v[0]:v[1] for v in tmp}
-    self.bot.db[context.guild.id].create_table(_name, _primary_keys, **kwargs)
+    await self.bot.db[context.guild.id].aio.create_table(_name, _primary_keys, **kwargs)
     await context.send(self.bot.db[context.guild.id].info(_name))
     fields = {
       "Table":_name,
@@ -81,7 +98,7 @@ class DatabaseManagementCog(commands.Cog, name="Database Commands"):
   )
   @has_admin_role()
   async def _insert_or_replace(self, context, _name, *args):
-    combined_key = self.bot.db[context.guild.id].insert_or_update(_name, *args)
+    combined_key = await self.bot.db[context.guild.id].aio.insert_or_update(_name, *args)
     await context.send(f"Updated entry {combined_key} in table {_name}.")
     fields = {
       "Table":_name,
@@ -112,7 +129,7 @@ class DatabaseManagementCog(commands.Cog, name="Database Commands"):
   )
   @has_admin_role()
   async def _db_delete_row(self, context, _name, *args):
-    self.bot.db[context.guild.id].delete_row(_name, args)
+    await self.bot.db[context.guild.id].aio.delete_row(_name, args)
     _key = " ".join(args)
     await context.send(f"Deleted row {_key} in table {_name}.")
     fields = {
@@ -132,7 +149,7 @@ class DatabaseManagementCog(commands.Cog, name="Database Commands"):
   )
   @has_admin_role()
   async def _db_drop_table(self, context, _name):
-    self.bot.db[context.guild.id].delete_table(_name)
+    await self.bot.db[context.guild.id].aio.delete_table(_name)
     await context.send(f"Deleted table {_name}.")
     await self.bot.log_message(context.guild, "ADMIN_LOG",
       user=context.author, action="deleted table",
@@ -151,19 +168,17 @@ class DatabaseManagementCog(commands.Cog, name="Database Commands"):
   @has_admin_role()
   async def _select_by_key(self, context, _name, *_values):
     if len(_values) == 0:
-      results = self.bot.db[context.guild.id].select(_name)
-      if results:
-        i=0
-        for result in results:
-          result_string = "\n".join([f"{k} = {v}" for k,v in result.items()])
-          #log_entry = ", ".join([f"{k}={v}" for k,v in result.items()])
-          await context.send(f"Result {i}:\n```{result_string}```")
-          i+=1
-      else:
+      i=0
+      async for result in self.bot.db[context.guild.id].aio.select_iter(_name):
+        result_string = "\n".join([f"{k} = {v}" for k,v in result.items()])
+        #log_entry = ", ".join([f"{k}={v}" for k,v in result.items()])
+        await context.send(f"Result {i}:\n```{result_string}```")
+        i+=1
+      if i == 0:
         await context.send(f"Result:\n```No entry```")
       fields = {
         "Table":_name,
-        "Result":f"{len(results) if results else 0} entries"
+        "Result":f"{i} entries"
       }
       await self.bot.log_message(context.guild, "ADMIN_LOG",
         user=context.author, action="selected table",
@@ -171,7 +186,7 @@ class DatabaseManagementCog(commands.Cog, name="Database Commands"):
       )
 
     else:
-      result = self.bot.db[context.guild.id].select(_name, _values)
+      result = await self.bot.db[context.guild.id].aio.select(_name, _values)
       if result:
         result_string = "\n".join([f"{k} = {v}" for k,v in result.items()])
         await context.send(f"Result:\n```{result_string}```")
@@ -197,7 +212,7 @@ class DatabaseManagementCog(commands.Cog, name="Database Commands"):
   )
   @commands.is_owner()
   async def _execute_query(self, context, *, query):
-    result = self.bot.db[context.guild.id].query(query)
+    result = await self.bot.db[context.guild.id].aio.query(query)
     if result is None:
       await context.send("Query executed.")
     else:
@@ -213,6 +228,48 @@ class DatabaseManagementCog(commands.Cog, name="Database Commands"):
     )
 
 
+  @_db.command(
+    name="stats",
+    brief="Shows the slowest queries",
+    help="Parameters:\n  number - the number of statements to show (default 5)",
+    description="This command shows the statements of this server that took the most time since the database was opened.",
+    usage="[number]"
+  )
+  @commands.is_owner()
+  async def _stats(self, context, number:int=5):
+    top = self.bot.db[context.guild.id].profiler.top(number)
+    if not top:
+      await context.send("```No queries recorded```")
+      return
+    for i, stats in enumerate(top):
+      statement = stats.statement[:1500] + '...' if len(stats.statement) > 1500 else stats.statement
+      await context.send(f"Statement {i}:\n```{statement}```"
+                         f"```count: {stats.count}, total: {stats.total*1000:.1f} ms, p50: {stats.percentile(50)*1000:.2f} ms, "
+                         f"p95: {stats.percentile(95)*1000:.2f} ms, max: {stats.max*1000:.2f} ms, rows: {stats.rows}```")
+
+  @_db.command(
+    name="maintenance",
+    brief="Shows the database maintenance",
+    description="This command shows the last maintenance of the database and the message archive of this server.",
+  )
+  @commands.is_owner()
+  async def _maintenance(self, context):
+    lines = []
+    for db_map in (self.bot.db, self.bot.archives):
+      if context.guild.id not in db_map:
+        continue
+      name = db_map.databases[context.guild.id].name
+      report = self.maintenance.reports.get(name)
+      if report is None:
+        lines.append(f"{name}: not maintained yet")
+        continue
+      timestamp, before, after = report
+      state = "unfinished" if name in self.maintenance.unfinished else "finished"
+      lines.append(f"{name}: {state} {time.time()-timestamp:.0f}s ago\n"
+                   f"  before: {before['size']/2**20:.2f} MiB, {before['free_pages']} free pages\n"
+                   f"  after: {after['size']/2**20:.2f} MiB, {after['free_pages']} free pages")
+    await context.send("```" + ("\n".join(lines) or "No database") + "```")
+
   @_db.command(
     name="info",
     brief="Displays info on the db",
@@ -230,19 +287,41 @@ class DatabaseManagementCog(commands.Cog, name="Database Commands"):
   @commands.max_concurrency(1)
   @commands.is_owner()
   async def _backup(self, context):
-    try:
-      await context.send(f"```Backing up the database...```")
-      backupFolder = f"backup_{round(time.time())}"
-      os.mkdir(backupFolder)
-      for files in os.listdir(path):
-        if files.endswith('.json') or files.endswith('.db'):
-          shutil.copyfile(os.path.join(path, files), os.path.join(backupFolder,files))
-      await context.send(f"```Completed```")
-    except Exception as e:
-      raise e
+    message = await context.send(f"```Backing up the database...```")
+    last_update = time.time()
+    async def progress(done, total):
+      nonlocal last_update
+      if time.time() - last_update > 2: # do not edit the message too often
+        last_update = time.time()
+        await message.edit(content=f"```Backing up the database... {done}/{total} files```")
+    folder, size = await self.backups.backup(self.bot.db.values(), progress=progress)
+    await message.edit(content=f"```Completed: {folder} ({size/2**20:.1f} MiB)```")
     await self.bot.log_message(context.guild, "ADMIN_LOG",
       user=context.author, action="backed up database",
-      timestamp=context.message.created_at
+      description=f"**Folder:**\n{folder}", timestamp=context.message.created_at
+    )
+
+  @_db.command(
+    name="restore",
+    brief="Restores database",
+    help="Parameters:\n  folder - the backup folder, e.g. backup_1600000000",
+    description="This command restores the database of this server from a backup. The current content is replaced.",
+    usage="folder"
+  )
+  @commands.max_concurrency(1)
+  @commands.is_owner()
+  async def _restore(self, context, folder):
+    if not os.path.isdir(folder) or not os.path.basename(os.path.normpath(folder)).startswith("backup_"):
+      raise FileNotFoundError(f"{folder} is not a backup folder.")
+    message = await context.send(f"```Restoring the database from {folder}...```")
+    db = self.bot.db[context.guild.id]
+    await self.backups.restore(db, folder)
+    # the settings are kept in memory
+    self.bot.settings[context.guild.id].load_memory()
+    await message.edit(content=f"```Completed```")
+    await self.bot.log_message(context.guild, "ADMIN_LOG",
+      user=context.author, action="restored database",
+      description=f"**Folder:**\n{folder}", timestamp=context.message.created_at
     )
 
   @_backup.error
@@ -254,6 +333,17 @@ class DatabaseManagementCog(commands.Cog, name="Database Commands"):
     else:
       await context.send(f"Sorry {context.author.mention}, something unexpected happened while backing up data.")
 
+  @_restore.error
+  async def _restore_error(self, context, error):
+    if isinstance(error, commands.CheckFailure):
+      await context.send(f"Sorry {context.author.mention}, but you do not have permission to restore data.")
+    elif isinstance(error, commands.MaxConcurrencyReached):
+      await context.send(f"Sorry {context.author.mention}, but only {error.number} user(s) can execute `{context.command.qualified_name}` at the same time!")
+    elif isinstance(error, commands.CommandInvokeError) and isinstance(error.original, (FileNotFoundError, RuntimeError)):
+      await context.send(f"Sorry {context.author.mention}, but {error.original}")
+    else:
+      await context.send(f"Sorry {context.author.mention}, something unexpected happened while restoring data.")
+
 #This function is needed for the load_extension routine.
 def setup(bot):
   bot.add_cog(DatabaseManagementCog(bot))
@@ -11,18 +11,34 @@ from base.modules.access_checks import has_mod_role, check_channel_permissions
 from base.modules.constants import CACHE_PATH as path
 from base.modules.message_helper import naive_time_to_seconds
 from base.modules.serializable_object import dump_json, ChannelWhiteListEntry
+from base.modules.settings_manager import SettingsSubscriber
 import logging
 
 logger = logging.getLogger(__name__)
 
+url_regex = re.compile(r"(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'\".,<>?«»“”‘’]))")
+
+# whether a message with the embed urls needs to be suppressed, by SUPPRESS_FILTER
+suppress_filters = {
+  "HEAVY": lambda message, embed_urls: bool(embed_urls or message.embeds), # will suppress all with embeds
+  "MEDIUM": lambda message, embed_urls: bool(embed_urls), # will suppress all with any embed meeting the criterial
+  "LIGHT": lambda message, embed_urls: len(embed_urls) == 1 and embed_urls[0] == message.content, # will suppress one-link message
+}
+
 def isPrivateChannel(channel):
   # check whether the channel is private in a guild
   channel_permission = channel.overwrites_for(channel.guild.default_role)
   return channel_permission.read_messages == False or channel_permission.send_messages == False
 
-class MediaManagementCog(commands.Cog, name="Media Management Commands"):
+class MediaManagementCog(commands.Cog, SettingsSubscriber, name="Media Management Commands"):
+  # the settings read on every guild message, they are kept in guild_settings by the settings bus
+  subscribed_settings = ["SUPPRESS_MODE", "SUPPRESS_FILTER", "SUPPRESS_DELAY", "SUPPRESS_POSITION", "SUPPRESS_LIMIT",
+                         "SUPPRESS_CHANNEL", "MEDIA_RATE_LIMIT", "MEDIA_ALERT_CD"]
+
   def __init__(self, bot):
     self.bot = bot
+    self.suppress_filters = {}
+    self.subscribe_settings()
     if not os.path.isdir(path):
       os.mkdir(path)
     self.white_list = ChannelWhiteListEntry.from_json(f'{path}/white_list.json')
@@ -82,10 +98,10 @@ class MediaManagementCog(commands.Cog, name="Media Management Commands"):
       now = datetime.now().timestamp()
       cycle = self.get_media_cycle(guild)
       tbegin = now - cycle * 3600
-      self.bot.db[guild.id].query(f"DELETE FROM media WHERE time<={tbegin} AND suppress<=0")
+      await self.bot.db[guild.id].aio.query(f"DELETE FROM media WHERE time<={tbegin} AND suppress<=0")
       logger.debug(f"Finished cleaning media table in {guild.name} ({guild.id}).")
       # show details of records during the last cycle
-      user_history, channel_history = self.get_media_history(guild, tbegin=tbegin)
+      user_history, channel_history = await self.get_media_history(guild, tbegin=tbegin)
       if not user_history:
         await self.bot.log_message(guild, "MESSAGE_LOG", title="Cleaned media records")
         return
@@ -100,6 +116,7 @@ class MediaManagementCog(commands.Cog, name="Media Management Commands"):
       await self.bot.on_task_error("Clean media table", error, guild)
   
   def cog_unload(self):
+    self.unsubscribe_settings()
     dump_json(self.white_list, f'{path}/white_list.json')
 
   async def cog_command_error(self, context, error):
@@ -125,23 +142,28 @@ class MediaManagementCog(commands.Cog, name="Media Management Commands"):
       return
     await self.update_media_on_message(message)
     
+  def update_setting(self, guild_id, key, value):
+    super().update_setting(guild_id, key, value)
+    if key == "SUPPRESS_FILTER":
+      self.suppress_filters[guild_id] = suppress_filters.get(value)
+
   def get_suppress_mode(self, guild):
-    return self.bot.get_setting(guild, "SUPPRESS_MODE")
+    return self.get_guild_setting(guild, "SUPPRESS_MODE")
     
   def get_suppress_filter(self, guild):
-    return self.bot.get_setting(guild, "SUPPRESS_FILTER")
+    return self.get_guild_setting(guild, "SUPPRESS_FILTER")
     
   def get_suppress_delay(self, guild):
-    return self.bot.get_setting(guild, "SUPPRESS_DELAY")
+    return self.get_guild_setting(guild, "SUPPRESS_DELAY")
     
   def get_suppress_position(self, guild):
-    return self.bot.get_setting(guild, "SUPPRESS_POSITION")
+    return self.get_guild_setting(guild, "SUPPRESS_POSITION")
     
   def get_suppress_limit(self, guild):
-    return self.bot.get_setting(guild, "SUPPRESS_LIMIT")
+    return self.get_guild_setting(guild, "SUPPRESS_LIMIT")
     
   def get_suppress_channel(self, guild):
-    return self.bot.get_setting(guild, "SUPPRESS_CHANNEL")
+    return self.get_guild_setting(guild, "SUPPRESS_CHANNEL")
     
   def get_media_clean(self, guild):
     return self.bot.get_setting(guild, "MEDIA_CLEAN")
@@ -150,10 +172,10 @@ class MediaManagementCog(commands.Cog, name="Media Management Commands"):
     return self.bot.get_setting(guild, "MEDIA_CYCLE")
     
   def get_media_rate_limit(self, guild):
-    return self.bot.get_setting(guild, "MEDIA_RATE_LIMIT")
+    return self.get_guild_setting(guild, "MEDIA_RATE_LIMIT")
     
   def get_media_alert_cd(self, guild):
-    return self.bot.get_setting(guild, "MEDIA_ALERT_CD")
+    return self.get_guild_setting(guild, "MEDIA_ALERT_CD")
         
   def channel_in_white_list(self, channel):
     suppress_channel = self.get_suppress_channel(channel.guild)
@@ -181,20 +203,20 @@ class MediaManagementCog(commands.Cog, name="Media Management Commands"):
     guild = message.guild
     member = message.author
     # update position of messages before
-    self.bot.db[guild.id].query(f"UPDATE media SET pos=pos+1 WHERE cid={channel.id}")
+    await self.bot.db[guild.id].aio.query(f"UPDATE media SET pos=pos+1 WHERE cid={channel.id}")
     # insert the new media message
     media, need_suppress = self.filter_media(message)
     check = media or need_suppress
     if check:
       suppress = 1 if need_suppress else -1
-      self.bot.db[guild.id].insert_or_update("media", message.id, naive_time_to_seconds(message.created_at), member.id, channel.id, json.dumps(media), 1, suppress)
+      await self.bot.db[guild.id].aio.insert_or_update("media", message.id, naive_time_to_seconds(message.created_at), member.id, channel.id, json.dumps(media), 1, suppress)
     # suppress the messages that meet the criteria
-    self.suppress_message(channel)
+    await self.suppress_message(channel)
     # check the rate of media and send alert
     if check:
       await self.media_alert(message)
           
-  def suppress_message(self, channel):
+  async def suppress_message(self, channel):
     # suppress the messages that meet the criteria
     guild = channel.guild
     if not channel.permissions_for(guild.me).manage_messages:
@@ -216,13 +238,13 @@ class MediaManagementCog(commands.Cog, name="Media Management Commands"):
       where_clause = f"({where_clause_delay}) AND ({where_clause_position})"
     else:
       return
-    results = self.bot.db[guild.id].query(f"WITH temp as (SELECT * FROM media WHERE cid={channel.id} AND suppress>0) SELECT mid FROM temp WHERE {where_clause}")
+    results = await self.bot.db[guild.id].aio.query(f"WITH temp as (SELECT * FROM media WHERE cid={channel.id} AND suppress>0) SELECT mid FROM temp WHERE {where_clause}")
     if results:
       message_ids = [mid[0] for mid in results]
       for mid in message_ids:
         asyncio.ensure_future(self.suppress_message_based_on_id(channel, mid)) # create task to run in background to avoid time delay
       id_list = ", ".join(str(mid) for mid in message_ids)
-      self.bot.db[guild.id].query(f"UPDATE media SET suppress=0 WHERE mid IN ({id_list})")
+      await self.bot.db[guild.id].aio.query(f"UPDATE media SET suppress=0 WHERE mid IN ({id_list})")
       
   async def media_alert(self, message):
     guild = message.guild
@@ -236,7 +258,7 @@ class MediaManagementCog(commands.Cog, name="Media Management Commands"):
     
     # member alert
     if member.id not in self.alert_cd[guild.id] or self.alert_cd[guild.id][member.id] + alert_cd < tnow:
-      member_history = self.get_media_history(guild, member=member, channel=None, tbegin=tnow-3600)
+      member_history = await self.get_media_history(guild, member=member, channel=None, tbegin=tnow-3600)
       member_rate = sum(num for _, num in member_history)
       if member_rate > rate_limit:
         fields = {
@@ -251,7 +273,7 @@ class MediaManagementCog(commands.Cog, name="Media Management Commands"):
     
     # channel alert
     if channel.id not in self.alert_cd[guild.id] or self.alert_cd[guild.id][channel.id] + alert_cd < tnow:
-      channel_history = self.get_media_history(guild, member=None, channel=channel, tbegin=tnow-3600)
+      channel_history = await self.get_media_history(guild, member=None, channel=channel, tbegin=tnow-3600)
       channel_rate = sum(num for _, num in channel_history)
       if channel_rate > rate_limit:
         fields = {
@@ -276,24 +298,17 @@ class MediaManagementCog(commands.Cog, name="Media Management Commands"):
     for attachment in message.attachments:
       if attachment.height:
         attachment_url.append(attachment.url)
-    regex = r"(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'\".,<>?«»“”‘’]))"
-    urls = re.findall(regex, message.content)
+    urls = url_regex.findall(message.content)
     for url in urls:
       url = url[0]
       if url not in embed_urls and self.is_suppress_link(url):
         embed_urls.append(url)
     # check whether the message need suppress
-    need_suppress = False
-    sfilter = self.get_suppress_filter(message.guild)
-    if sfilter == "HEAVY": # will suppress all with embeds
-      if embed_urls or message.embeds:
-        need_suppress = True
-    elif sfilter == "MEDIUM": # will suppress all with any embed meeting the criterial
-      if embed_urls:
-        need_suppress = True
-    elif sfilter == "LIGHT": # will suppress one-link message
-      if len(embed_urls) == 1 and embed_urls[0] == message.content:
-        need_suppress = True
+    if message.guild.id in self.suppress_filters:
+      sfilter = self.suppress_filters[message.guild.id]
+    else:
+      sfilter = suppress_filters.get(self.get_suppress_filter(message.guild))
+    need_suppress = sfilter is not None and sfilter(message, embed_urls)
     media = embed_urls + attachment_url
     return media, need_suppress
   
@@ -310,14 +325,14 @@ class MediaManagementCog(commands.Cog, name="Media Management Commands"):
     except:
       pass
       
-  def get_media_history(self, guild, member=None, channel=None, tbegin=0):
+  async def get_media_history(self, guild, member=None, channel=None, tbegin=0):
     if not member and not channel:
-      result1 = self.bot.db[guild.id].query(f"SELECT aid, COUNT(mid) AS num FROM media WHERE time>{tbegin} "
+      result1 = await self.bot.db[guild.id].aio.query(f"SELECT aid, COUNT(mid) AS num FROM media WHERE time>{tbegin} "
                                             f"GROUP BY aid ORDER BY num DESC")
       if not result1:
         return [], [] # don't need to send the second query if there is no data
       user_history = [[guild.get_member(aid), num] for aid, num in result1]
-      result2 = self.bot.db[guild.id].query(f"SELECT cid, COUNT(mid) AS num FROM media WHERE time>{tbegin} "
+      result2 = await self.bot.db[guild.id].aio.query(f"SELECT cid, COUNT(mid) AS num FROM media WHERE time>{tbegin} "
                                             f"GROUP BY cid ORDER BY num DESC")
       channel_history = [[guild.get_channel(cid), num] for cid, num in result2]
       return user_history, channel_history
@@ -336,7 +351,7 @@ class MediaManagementCog(commands.Cog, name="Media Management Commands"):
       where_clause = f"cid={channel.id}"
       group_clause = "aid"
       row_trans = lambda row: [guild.get_member(row[0]), row[1]]
-    results = self.bot.db[guild.id].query(f"SELECT {select_clause} FROM media WHERE time>{tbegin} and ({where_clause}) "
+    results = await self.bot.db[guild.id].aio.query(f"SELECT {select_clause} FROM media WHERE time>{tbegin} and ({where_clause}) "
                                           f"GROUP BY {group_clause} ORDER BY num DESC")
     return [row_trans(row) for row in results]
     
@@ -361,7 +376,7 @@ class MediaManagementCog(commands.Cog, name="Media Management Commands"):
   )
   @has_mod_role()
   async def _media(self, context, member:typing.Optional[discord.Member], channel:typing.Optional[discord.TextChannel], hours:float=1.0):
-    history = self.get_media_history(context.guild, member, channel, datetime.now().timestamp()-hours*3600)
+    history = await self.get_media_history(context.guild, member, channel, datetime.now().timestamp()-hours*3600)
     if not history or (isinstance(history, tuple) and not history[0]):
       member_info = f" for {member.mention}" if member else ""
       channel_info = f" in {channel.mention}" if channel else ""
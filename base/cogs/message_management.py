@@ -3,15 +3,16 @@ import discord
 import os
 import typing
 from queue import Queue
-from discord.ext import commands
+from discord.ext import commands, tasks
 from base.modules.access_checks import has_mod_role, check_channel_permissions
 from datetime import datetime, timezone
 from base.modules.serializable_object import MessageCache, MessageSchedule, CommandSchedule, dump_json
 from base.modules.basic_converter import FutureTimeConverter, PastTimeConverter, EmojiUnion, TimedeltaConverter
 from base.modules.constants import CACHE_PATH as path
 from base.modules.message_helper import get_message_attachments, send_temp_message, wait_user_confirmation,\
-                                        save_message, get_message_brief, get_full_message, clean_message_files
+                                        save_messages, get_message_brief, get_full_message, clean_message_files
 from base.modules.special_bot_methods import special_process_command, command_check
+from base.modules.settings_manager import SettingsSubscriber
 import logging
 
 logger = logging.getLogger(__name__)
@@ -26,9 +27,13 @@ class MaxSizeList(list):
     if super().__len__() > self.maxsize:
       super().__delitem__(0)
 
-class MessageManagementCog(commands.Cog, name="Message Management Commands"):
+class MessageManagementCog(commands.Cog, SettingsSubscriber, name="Message Management Commands"):
+  # the settings read on every message event, they are kept in guild_settings by the settings bus
+  subscribed_settings = ["NUM_DELETE_CACHE", "MESSAGE_LOG"]
+
   def __init__(self, bot):
     self.bot = bot
+    self.subscribe_settings()
     if not os.path.isdir(path):
       os.mkdir(path)
     self.delete_cache = MessageCache.from_json(f'{path}/delete_cache.json')
@@ -36,6 +41,7 @@ class MessageManagementCog(commands.Cog, name="Message Management Commands"):
     self.delete_queue = MaxSizeList(maxsize=100)
     for guild in self.bot.guilds:
       self.init_guild(guild)
+    self.archive_messages.start()
     
   def init_guild(self, guild):
     if guild.id not in self.delete_cache:
@@ -47,14 +53,47 @@ class MessageManagementCog(commands.Cog, name="Message Management Commands"):
       schedule.set_timer(guild, self.bot, self.scheduler[guild.id])
   
   def cog_unload(self):
+    self.unsubscribe_settings()
+    self.archive_messages.cancel()
     for key, msglist in self.scheduler.items():
       for msg in msglist:
         msg.cancel()
     dump_json(self.delete_cache, f'{path}/delete_cache.json')
     dump_json(self.scheduler, f'{path}/scheduler.json')
       
+  @tasks.loop(hours=6)
+  async def archive_messages(self):
+    for guild in self.bot.guilds:
+      if guild.id in self.bot.intialized and self.bot.intialized[guild.id]:
+        try:
+          await self.archive_guild(guild)
+        except Exception as e:
+          logger.error(f"{e.__class__.__name__} occurs when archiving the messages of {guild.name} ({guild.id}): {e}")
+
+  @archive_messages.before_loop
+  async def before_archive_messages(self):
+    await self.bot.wait_until_ready()
+
+  async def archive_guild(self, guild):
+    # moves the saved messages older than ARCHIVE_AGE into the compressed archive of the guild
+    age = self.bot.get_setting(guild, "ARCHIVE_AGE")
+    if age <= 0:
+      return
+    before = time.time() - age*86400
+    db = self.bot.db[guild.id]
+    if not await db.aio.query(f"SELECT mid FROM messages WHERE time<{before} LIMIT 1"):
+      return
+    archive = self.bot.archives[guild.id]
+    moved = await archive.aio.run(archive.archive, db, before)
+    logger.info(f"Archived {moved} message(s) of {guild.name} ({guild.id}).")
+
+  def message_dbs(self, guild):
+    # the guild database and the archive of the guild if it exists, the saved messages are in either of them
+    archive = self.bot.get_archive(guild)
+    return [self.bot.db[guild.id]] if archive is None else [self.bot.db[guild.id], archive]
+
   def get_max_cache(self, guild):
-    return self.bot.get_setting(guild, "NUM_DELETE_CACHE")
+    return self.get_guild_setting(guild, "NUM_DELETE_CACHE")
 
   async def cog_command_error(self, context, error):
     if hasattr(context.command, "on_error"):
@@ -70,6 +109,8 @@ class MessageManagementCog(commands.Cog, name="Message Management Commands"):
       await context.send(f"Sorry {context.author.mention}, but I could not understand the arguments passed to `{context.command.qualified_name}`.")
     elif isinstance(error, commands.CommandInvokeError) and isinstance(error.original, discord.Forbidden):
       await context.send(f"Sorry {context.author.mention}, but I do not have permission to post in the specified channel.")
+    elif isinstance(error, commands.CommandInvokeError) and isinstance(error.original, (ValueError, RuntimeError)):
+      await context.send(f"Sorry {context.author.mention}, but {error.original}")
     elif isinstance(error, commands.MaxConcurrencyReached):
       await context.send(f"Sorry {context.author.mention}, but only {error.number} user(s) can execute `{context.command.qualified_name}` at the same time!")
     else:
@@ -78,7 +119,7 @@ class MessageManagementCog(commands.Cog, name="Message Management Commands"):
   #@commands.Cog.listener() -> will be triggered by the on_raw_message_delete event
   async def on_message_delete(self, message):
     if message.guild:
-      if self.bot.get_setting(message.guild, "MESSAGE_LOG") == "OFF":
+      if self.get_guild_setting(message.guild, "MESSAGE_LOG") == "OFF":
         return
       if await self.bot.is_command(message) or message.author == self.bot.user: # ignore command message
         return
@@ -120,7 +161,7 @@ class MessageManagementCog(commands.Cog, name="Message Management Commands"):
       return
     if payload.guild_id:
       guild = discord.utils.get(self.bot.guilds, id=payload.guild_id)
-      if self.bot.get_setting(guild, "MESSAGE_LOG") == "OFF":
+      if self.get_guild_setting(guild, "MESSAGE_LOG") == "OFF":
         return
       channel = discord.utils.get(guild.text_channels, id=payload.channel_id)
       fields = {
@@ -740,18 +781,18 @@ class MessageManagementCog(commands.Cog, name="Message Management Commands"):
       channel = context.channel
     elif channel != context.channel:
       check_channel_permissions(channel, context.author, ["read_messages", "read_message_history", "manage_messages"])
-    saved = 0
+    messages = []
     msg_count = 0
     async for message in channel.history():
-      if saved >= num:
+      if len(messages) >= num:
         break
       if message.id == context.message.id:
         continue # skip the command
       if len(members) == 0 or message.author in members:
         msg_count += 1
         if msg_count > skip_num: # skip the first m messages
-          await save_message(self.bot, message)
-          saved += 1
+          messages.append(message)
+    saved = await save_messages(self.bot, context.guild, messages)
     fields = {
       "Author(s)":"\n".join([f"{member}({member.id})" for member in members]) if members else None,
       "Channel":f"{channel.mention}\nCID: {channel.id}",
@@ -774,7 +815,10 @@ class MessageManagementCog(commands.Cog, name="Message Management Commands"):
   @commands.bot_has_permissions(read_messages=True, read_message_history=True, send_messages=True, manage_messages=True)
   @has_mod_role()
   async def _fetch_msg(self, context, messageID:int):
-    result = self.bot.db[context.guild.id].select("messages", messageID)
+    for db in self.message_dbs(context.guild):
+      result = await db.aio.select("messages", messageID)
+      if result:
+        break
     if not result:
       await context.send("Message not found.")
       return
@@ -795,12 +839,15 @@ class MessageManagementCog(commands.Cog, name="Message Management Commands"):
   @commands.bot_has_permissions(read_messages=True, read_message_history=True, send_messages=True, manage_messages=True)
   @has_mod_role()
   async def _delete_msg(self, context, messageID:int):
-    result = self.bot.db[context.guild.id].select("messages", messageID)
+    for db in self.message_dbs(context.guild):
+      result = await db.aio.select("messages", messageID)
+      if result:
+        break
     if not result:
       await context.send("Message not found.")
       return
     clean_message_files(result)
-    self.bot.db[context.guild.id].delete_row("messages", messageID)
+    await db.aio.delete_row("messages", messageID)
     await context.send(f"Message with MID {messageID} was deleted.")
     await self.bot.log_message(context.guild, "MOD_LOG",
       user=context.author, action="deleted a message from the database",
@@ -836,9 +883,14 @@ class MessageManagementCog(commands.Cog, name="Message Management Commands"):
       where_clause = "TRUE"
     if date:
       order_clause = f"ABS({date.timestamp()}-time)"
+      order_key = lambda row: abs(date.timestamp()-row[1])
     else:
       order_clause = "time DESC"
-    result = self.bot.db[context.guild.id].query(f"SELECT * FROM messages WHERE {where_clause} ORDER BY {order_clause} LIMIT {limit}")
+      order_key = lambda row: -row[1]
+    result = []
+    for db in self.message_dbs(context.guild):
+      result += await db.aio.query(f"SELECT * FROM messages WHERE {where_clause} ORDER BY {order_clause} LIMIT {limit}") or []
+    result = sorted(result, key=order_key)[:limit]
     if not result:
       await context.send("Message not found.")
       return
@@ -847,6 +899,31 @@ class MessageManagementCog(commands.Cog, name="Message Management Commands"):
       embed.add_field(name=f"Message {i+1}:", value=get_message_brief(result[i], self.bot, context.guild))
     await context.send(embed=embed)
     
+  @_msg.command(
+    name="find",
+    brief="Finds messages in db by keywords",
+    help="Finds the saved messages containing all keywords, the best matches first. A \"quoted phrase\" matches consecutive words and a word ending with * matches all words starting with it. Limit is the max number of results.",
+    usage="[limit=10] keywords..."
+  )
+  @commands.has_permissions(read_messages=True, read_message_history=True, send_messages=True, manage_messages=True)
+  @commands.bot_has_permissions(read_messages=True, read_message_history=True, send_messages=True, manage_messages=True)
+  @has_mod_role()
+  async def _find_msg(self, context, limit:typing.Optional[int]=10, *, keywords):
+    limit = min(limit, 25)
+    result = []
+    # the archived messages are older than the saved ones, they fill the results after the matches of the guild database
+    for db in self.message_dbs(context.guild):
+      if len(result) < limit:
+        result += await db.aio.search("messages", keywords, limit-len(result))
+    if not result:
+      await context.send("Message not found.")
+      return
+    embed = discord.Embed(title=f"Message Search Results", colour=discord.Colour.green(), timestamp=context.message.created_at)
+    for i, (row, snippet) in enumerate(result):
+      value = f"{get_message_brief(row, self.bot, context.guild)}\n{snippet}"
+      embed.add_field(name=f"Message {i+1}:", value=value[:1021] + '...' if len(value) > 1024 else value)
+    await context.send(embed=embed)
+
   @_msg.command(
     name="purge",
     brief="Purges messages in db",
@@ -885,28 +962,33 @@ class MessageManagementCog(commands.Cog, name="Message Management Commands"):
       hint_msg = " ".join(hint_msg) + " "
     else:
       hint_msg = ""
-    # check how many messages will be deleted
-    num = self.bot.db[context.guild.id].query(f"SELECT COUNT(*) FROM messages WHERE {where_clause}")
-    if not num or num[0][0]==0:
+    # check how many messages will be deleted, the archived messages are purged as well
+    dbs = self.message_dbs(context.guild)
+    num = 0
+    for db in dbs:
+      count = await db.aio.query(f"SELECT COUNT(*) FROM messages WHERE {where_clause}")
+      num += count[0][0] if count else 0
+    if num==0:
       await context.send("Message not found.")
       return
-    confirm, msg = await wait_user_confirmation(context, f"{num[0][0]} message(s) {hint_msg}will be deleted, do you want to process?")
+    confirm, msg = await wait_user_confirmation(context, f"{num} message(s) {hint_msg}will be deleted, do you want to process?")
     if not confirm:
       await context.send("Operation cancelled.")
       return
-    # delete all the files
-    result = self.bot.db[context.guild.id].query(f"SELECT * FROM messages WHERE {where_clause} AND length(files)>2")
-    if result:
-      for row in result:
-        clean_message_files(row)
-    # delete the messages in db
-    self.bot.db[context.guild.id].query(f"DELETE FROM messages WHERE {where_clause}")
-    await context.send(f"{num[0][0]} message(s) have been deleted.")
+    for db in dbs:
+      # delete all the files
+      result = await db.aio.query(f"SELECT * FROM messages WHERE {where_clause} AND length(files)>2")
+      if result:
+        for row in result:
+          clean_message_files(row)
+      # delete the messages in db
+      await db.aio.query(f"DELETE FROM messages WHERE {where_clause}")
+    await context.send(f"{num} message(s) have been deleted.")
     fields = {
       "Author(s)":"\n".join([member.mention for member in members]) if members else None,
       "Channel(s)":"\n".join([channel.mention for channel in channels]) if channels else None,
       "Before":date.strftime('%Y-%m-%d %H:%M:%S %z') if date else None,
-      "Num":f"{num[0][0]} message(s)"
+      "Num":f"{num} message(s)"
     }
     await self.bot.log_message(context.guild, "MOD_LOG",
       user=context.author, action="purged messages",
@@ -6,14 +6,19 @@ from discord.ext import commands, tasks
 from base.modules.access_checks import has_mod_role, has_admin_role, is_server_owner, mod_role_check
 from base.modules.message_helper import wait_user_confirmation
 from base.modules.basic_converter import MemberOrUser
+from base.modules.settings_manager import SettingsSubscriber
 import logging
 
 logger = logging.getLogger(__name__)
 
-class UserManagementCog(commands.Cog, name="User Management Commands"):
+class UserManagementCog(commands.Cog, SettingsSubscriber, name="User Management Commands"):
+  # the settings read by the moderation commands, they are kept in guild_settings by the settings bus
+  subscribed_settings = ["MAX_WARNINGS", "WARN_DURATION", "MUTE_DURATION"]
+
   def __init__(self, bot):
     self.bot = bot
     self.update_tasks = {}
+    self.subscribe_settings()
     for guild in self.bot.guilds:
       self.start_new_task(guild)
       
@@ -60,6 +65,7 @@ class UserManagementCog(commands.Cog, name="User Management Commands"):
       self.update_tasks[guild.id].change_interval(hours=hours)
     
   def cog_unload(self):
+    self.unsubscribe_settings()
     for guild_id, task in self.update_tasks.items():
       task.cancel()
     
@@ -79,7 +85,7 @@ class UserManagementCog(commands.Cog, name="User Management Commands"):
     if self.update_tasks[guild.id].current_loop > 0:
       logger.debug(f"Updating statistics in {guild.name} ({guild.id}).")
       try:
-        self.bot.update_user_stats(guild)
+        await self.bot.update_user_stats(guild)
         await self.bot.log_message(guild, "MOD_LOG", title="Updated user statistics")
       except Exception as error:
         await self.bot.on_task_error("Update user statistics", error, guild)
@@ -89,38 +95,32 @@ class UserManagementCog(commands.Cog, name="User Management Commands"):
   async def update_guild_slaps(self, guild):
     now = time.time()
     db = self.bot.db[guild.id]
-    slaps = db.select("user_warnings")
-    if slaps:
-      for slap in slaps:
-        if slap["count"] > 0 and now > slap["expires"]:
-          db.insert_or_update("user_warnings", slap["userid"], slap["username"], 0, slap["expires"])
-          fields = {
-            "User":f"{slap['username']}\nUID: {slap['userid']}",
-            "Expiry":f"{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(slap['expires']))} UTC"
-          }
-          await self.bot.log_message(guild, "MOD_LOG", title="Warning(s) expired", fields=fields)
-      await self.bot.log_message(guild, "MOD_LOG", title="Updated warning counts")
+    async for slap in db.aio.select_iter("user_warnings", "count>0 AND expires<?", (now,)):
+      await db.aio.insert_or_update("user_warnings", slap["userid"], slap["username"], 0, slap["expires"])
+      fields = {
+        "User":f"{slap['username']}\nUID: {slap['userid']}",
+        "Expiry":f"{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(slap['expires']))} UTC"
+      }
+      await self.bot.log_message(guild, "MOD_LOG", title="Warning(s) expired", fields=fields)
+    await self.bot.log_message(guild, "MOD_LOG", title="Updated warning counts")
       
   async def update_guild_mutes(self, guild):
     now = time.time()
     db = self.bot.db[guild.id]
-    mutes = db.select("users_muted")
     mute_role = self.bot.get_mute_role(guild)
-    if mutes:
-      for muted_user in mutes:
-        if now > muted_user["expires"]:
-          member = guild.get_member(muted_user["userid"])
-          if not member:
-            member = None
-          else:
-            await member.remove_roles(mute_role)
-          db.delete_row("users_muted", muted_user["userid"])
-          fields = {
-            "User":f"{member}\nUID: {muted_user['userid']}",
-            "Expiry":f"{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(muted_user['expires']))} UTC"
-          }
-          await self.bot.log_message(guild, "MOD_LOG", title="Mute expired", fields=fields)
-      await self.bot.log_message(guild, "MOD_LOG", title="Updated muted users")
+    async for muted_user in db.aio.select_iter("users_muted", "expires<?", (now,)):
+      member = guild.get_member(muted_user["userid"])
+      if not member:
+        member = None
+      else:
+        await member.remove_roles(mute_role)
+      await db.aio.delete_row("users_muted", muted_user["userid"])
+      fields = {
+        "User":f"{member}\nUID: {muted_user['userid']}",
+        "Expiry":f"{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(muted_user['expires']))} UTC"
+      }
+      await self.bot.log_message(guild, "MOD_LOG", title="Mute expired", fields=fields)
+    await self.bot.log_message(guild, "MOD_LOG", title="Updated muted users")
 
   async def cog_command_error(self, context, error):
     if hasattr(context.command, "on_error"):
@@ -142,13 +142,13 @@ class UserManagementCog(commands.Cog, name="User Management Commands"):
       await context.send(f"Sorry {context.author.mention}, something unexpected happened while executing that command.")
       
   def get_max_warnings(self, guild):
-    return self.bot.get_setting(guild, "MAX_WARNINGS")
+    return self.get_guild_setting(guild, "MAX_WARNINGS")
     
   def get_warn_duration(self, guild):
-    return self.bot.get_setting(guild, "WARN_DURATION")
+    return self.get_guild_setting(guild, "WARN_DURATION")
 
   def get_mute_duration(self, guild):
-    return self.bot.get_setting(guild, "MUTE_DURATION")
+    return self.get_guild_setting(guild, "MUTE_DURATION")
 
   @commands.Cog.listener()
   async def on_member_update(self, before, after):
@@ -284,12 +284,10 @@ class UserManagementCog(commands.Cog, name="User Management Commands"):
       pass
     #If a user was muted, prevent from unmuting itself by leaving and joining
     now = time.time()
-    mutes = self.bot.db[member.guild.id].select("users_muted")
+    muted_user = await self.bot.db[member.guild.id].aio.select("users_muted", member.id)
     mute_role = self.bot.get_mute_role(member.guild)
-    if mutes:
-      for muted_user in mutes:
-        if muted_user["userid"] == member.id and now > muted_user["expires"]:
-          await member.add_roles(mute_role)
+    if muted_user and now > muted_user["expires"]:
+      await member.add_roles(mute_role)
 
   #@commands.Cog.listener()
   #async def on_member_ban(self, guild, user):
@@ -311,11 +309,9 @@ class UserManagementCog(commands.Cog, name="User Management Commands"):
         user = context.author
       else:
         user = member
-    total = self.bot.db[context.guild.id].select("user_statistics", user.id)
-    if user.id in self.bot.user_stats[context.guild.id]:
-      result = self.bot.user_stats[context.guild.id][user.id]
-    else:
-      result = None
+    total = await self.bot.db[context.guild.id].aio.select("user_statistics", user.id)
+    # the counts since the last update of the table
+    result = self.bot.get_user_stats(context.guild).get(user.id)
     if not total and not result:
       await context.send("```None```")
     else:
@@ -422,7 +418,7 @@ class UserManagementCog(commands.Cog, name="User Management Commands"):
       elif member.top_role > context.guild.me.top_role:
         await context.send(f"Sorry {context.author.mention}, but I do not have enough power to mute {member}!")
         continue
-      self.bot.db[context.guild.id].insert_or_update("users_muted", member.id, expiry)
+      await self.bot.db[context.guild.id].aio.insert_or_update("users_muted", member.id, expiry)
       await member.add_roles(mute_role)
       await context.send(f"{member.mention} muted.")
       fields = {
@@ -493,7 +489,7 @@ class UserManagementCog(commands.Cog, name="User Management Commands"):
       elif member.top_role > context.guild.me.top_role:
         await context.send(f"Sorry {context.author.mention}, but I do not have enough power to unmute {member}!")
         continue
-      self.bot.db[context.guild.id].delete_row("users_muted", member.id)
+      await self.bot.db[context.guild.id].aio.delete_row("users_muted", member.id)
       await member.remove_roles(mute_role)
       await context.send(f"{member.mention} unmuted.")
       await self.bot.log_message(context.guild, "MOD_LOG",
@@ -565,7 +561,7 @@ class UserManagementCog(commands.Cog, name="User Management Commands"):
       elif member.top_role > context.guild.me.top_role:
         await context.send(f"Sorry {context.author.mention}, but I do not have enough power to warn {member}!")
         continue
-      warn_count = self.bot.db[context.guild.id].select("user_warnings", member.id)
+      warn_count = await self.bot.db[context.guild.id].aio.select("user_warnings", member.id)
       if warn_count is None:
         warn_count = 0
       else:
@@ -616,7 +612,7 @@ class UserManagementCog(commands.Cog, name="User Management Commands"):
           user=context.author, action="has been kicked (max warnings)", target=member,
           fields=fields, timestamp=context.message.created_at
         )
-      self.bot.db[context.guild.id].insert_or_update("user_warnings", member.id, f"{member}", warn_count+number, expiry + warn_duration*(warn_count+number))
+      await self.bot.db[context.guild.id].aio.insert_or_update("user_warnings", member.id, f"{member}", warn_count+number, expiry + warn_duration*(warn_count+number))
 
   @_warn.command(
     name="info",
@@ -630,7 +626,7 @@ class UserManagementCog(commands.Cog, name="User Management Commands"):
     if not mod_role_check(context) or len(members) == 0:
       members = [context.author]
     for member in members:
-      warning = self.bot.db[context.guild.id].select("user_warnings", member.id)
+      warning = await self.bot.db[context.guild.id].aio.select("user_warnings", member.id)
       embed = discord.Embed(title=f"Warning Status", colour=discord.Colour.gold(), timestamp=context.message.created_at)
       embed.add_field(name="User:", value=f"{member.mention}", inline=False)
       if warning is None:
@@ -674,7 +670,7 @@ class UserManagementCog(commands.Cog, name="User Management Commands"):
       elif member.top_role > context.guild.me.top_role:
         await context.send(f"Sorry {context.author.mention}, but I do not have enough power to remove warnings from {member}!")
         continue
-      warn_count = self.bot.db[context.guild.id].select("user_warnings", member.id)
+      warn_count = await self.bot.db[context.guild.id].aio.select("user_warnings", member.id)
       if warn_count is None:
         warn_count = 0
       else:
@@ -685,7 +681,7 @@ class UserManagementCog(commands.Cog, name="User Management Commands"):
         new_warn_count = warn_count-number
         new_expiry = expiry - warn_duration*number
         expire_time = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(new_expiry))
-        self.bot.db[context.guild.id].insert_or_update("user_warnings", member.id, f"{member}", new_warn_count, new_expiry)
+        await self.bot.db[context.guild.id].aio.insert_or_update("user_warnings", member.id, f"{member}", new_warn_count, new_expiry)
         try:
           await member.create_dm()
           await member.dm_channel.send(
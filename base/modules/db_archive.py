@@ -0,0 +1,90 @@
+import os
+import json
+import zlib
+import functools
+from base.modules.db_manager import Database
+from base.modules.constants import DB_PATH as path
+import logging
+
+logger = logging.getLogger(__name__)
+
+def zip_message(content, embeds, files):
+  return zlib.compress(json.dumps([content, embeds, files]).encode(), 9)
+
+@functools.lru_cache(maxsize=256)
+def unzip_message_fields(data):
+  # the view decompresses a row once for its three columns
+  return tuple(json.loads(zlib.decompress(data).decode()))
+
+def unzip_message(data, i):
+  return unzip_message_fields(data)[i]
+
+class MessageArchive(Database):
+  # Cold storage for the old rows of the messages table of a guild database, stored in its own file.
+  # content, embeds and files of a message are stored together as zlib compressed json, the other columns stay plain for the filters.
+  # The TEMP VIEW messages decompresses the rows, so the queries written for the messages table also work on the archive.
+  # The content is indexed by a FTS5 index reading the text through the view archived_messages_text, see search.
+  columns = {"mid":"int", "time":"real", "aid":"int", "cid":"int", "content":"txt", "embeds":"txt", "files":"txt"}
+
+  def __init__(self, _identifier, profile=None, pool_size=None):
+    super().__init__(_identifier, profile, pool_size)
+    self.tables["messages"] = {
+      "primary_key":["mid"],
+      "columns":dict(self.columns)
+    }
+    self.compile_table("messages")
+
+  def file_name(self, _identifier):
+    return f"{path}/archive_{_identifier}.db"
+
+  @classmethod
+  def exists(cls, _identifier):
+    return os.path.isfile(f"{path}/archive_{_identifier}.db")
+
+  def prepare_connection(self, conn):
+    conn.create_function("unzip_message", 2, unzip_message, deterministic=True)
+    if not conn.execute("SELECT name FROM sqlite_master WHERE name='archived_messages'").fetchone():
+      # the writer is prepared before the readers, it creates the table in a new file
+      with conn:
+        conn.execute("CREATE TABLE archived_messages(mid integer, time real, aid integer, cid integer, data blob, PRIMARY KEY(mid))")
+        conn.execute("CREATE INDEX idx_archived_messages_time ON archived_messages(time)")
+        conn.execute("CREATE INDEX idx_archived_messages_aid_time ON archived_messages(aid,time)")
+        conn.execute("CREATE INDEX idx_archived_messages_cid_time ON archived_messages(cid,time)")
+    if not conn.execute("SELECT name FROM sqlite_master WHERE name='archived_messages_text_fts'").fetchone():
+      # the triggers decompress the rows, so only connections with unzip_message can write to the archive
+      # an archive created before the full-text index is indexed once when it is opened
+      with conn:
+        conn.execute("CREATE VIEW IF NOT EXISTS archived_messages_text AS SELECT mid AS rowid,mid,time,aid,cid,"
+                     "unzip_message(data,0) AS content,unzip_message(data,1) AS embeds,unzip_message(data,2) AS files FROM archived_messages")
+        conn.execute("CREATE VIRTUAL TABLE archived_messages_text_fts USING fts5(content, content='archived_messages_text', "
+                     "content_rowid='mid', tokenize='unicode61 remove_diacritics 2')")
+        conn.execute("CREATE TRIGGER archived_messages_text_fts_insert AFTER INSERT ON archived_messages BEGIN "
+                     "INSERT INTO archived_messages_text_fts(rowid,content) VALUES (new.mid,unzip_message(new.data,0)); END")
+        conn.execute("CREATE TRIGGER archived_messages_text_fts_delete AFTER DELETE ON archived_messages BEGIN "
+                     "INSERT INTO archived_messages_text_fts(archived_messages_text_fts,rowid,content) VALUES ('delete',old.mid,unzip_message(old.data,0)); END")
+        conn.execute("CREATE TRIGGER archived_messages_text_fts_update AFTER UPDATE ON archived_messages BEGIN "
+                     "INSERT INTO archived_messages_text_fts(archived_messages_text_fts,rowid,content) VALUES ('delete',old.mid,unzip_message(old.data,0)); "
+                     "INSERT INTO archived_messages_text_fts(rowid,content) VALUES (new.mid,unzip_message(new.data,0)); END")
+        conn.execute("INSERT INTO archived_messages_text_fts(archived_messages_text_fts) VALUES ('rebuild')")
+    conn.execute("CREATE TEMP VIEW IF NOT EXISTS messages AS SELECT mid,time,aid,cid,"
+                 "unzip_message(data,0) AS content,unzip_message(data,1) AS embeds,unzip_message(data,2) AS files FROM archived_messages")
+    conn.execute("CREATE TEMP TRIGGER IF NOT EXISTS messages_delete INSTEAD OF DELETE ON messages BEGIN "
+                 "DELETE FROM archived_messages WHERE mid=old.mid; END")
+
+  def fts_source(self, _table):
+    # the search of messages uses the index of the decompressed content, the view has the mid as rowid column
+    return "archived_messages_text", ""
+
+  def archive(self, db, before, batch_size=1000):
+    # moves the messages of the guild database db older than before (s) into the archive, returns the number of moved messages
+    # a batch is written to the archive before it is deleted from db, an interrupted run loses no message
+    moved = 0
+    while True:
+      rows = db.query(f"SELECT mid,time,aid,cid,content,embeds,files FROM messages WHERE time<{float(before)} "
+                      f"ORDER BY time LIMIT {int(batch_size)}")
+      if not rows:
+        return moved
+      self.insert_many("archived_messages", [(mid, ctime, aid, cid, zip_message(content, embeds, files))
+                                             for mid, ctime, aid, cid, content, embeds, files in rows])
+      db.query(f"DELETE FROM messages WHERE mid IN ({','.join([str(row[0]) for row in rows])})")
+      moved += len(rows)
@@ -0,0 +1,94 @@
+try:
+  from pysqlite3 import dbapi2 as sqlite3
+except:
+  import sqlite3
+import os
+import time
+import gzip
+import shutil
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from base.modules.constants import DB_PATH as path
+import logging
+
+logger = logging.getLogger(__name__)
+
+class BackupEngine:
+  # Backs up the database files with the sqlite backup API in worker threads, the bot keeps reading and writing meanwhile.
+  # Every database is copied in steps of `pages` pages and stored as gzip file.
+  def __init__(self, workers=4, pages=256, compresslevel=6):
+    self.workers = workers
+    self.pages = pages
+    self.compresslevel = compresslevel
+
+  def backup_file(self, source, target):
+    # copies the database file source to the gzip file target, returns the size of the gzip file
+    tmp_file = f"{target}.tmp"
+    try:
+      src = sqlite3.connect(f"file:{source}?mode=ro", uri=True)
+      dst = sqlite3.connect(tmp_file)
+      try:
+        # the copy starts again if another connection writes in between two steps
+        src.backup(dst, pages=self.pages, sleep=0)
+      finally:
+        dst.close()
+        src.close()
+      with open(tmp_file, "rb") as f_in, gzip.open(target, "wb", compresslevel=self.compresslevel) as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    finally:
+      if os.path.isfile(tmp_file):
+        os.remove(tmp_file)
+    return os.path.getsize(target)
+
+  def restore_file(self, source, db):
+    # writes the gzip backup source into the open database db
+    tmp_file = f"{source}.tmp"
+    try:
+      with gzip.open(source, "rb") as f_in, open(tmp_file, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+      src = sqlite3.connect(f"file:{tmp_file}?mode=ro", uri=True)
+      try:
+        db.restore(src, self.pages)
+      finally:
+        src.close()
+    finally:
+      if os.path.isfile(tmp_file):
+        os.remove(tmp_file)
+
+  async def backup(self, databases=(), folder=None, progress=None):
+    # backs up all database files and settings files of the db folder, the queued writes of the databases are flushed first
+    # progress is an optional coroutine function, it is awaited with the number of finished and total files
+    # returns the backup folder and the total size of the backup
+    loop = asyncio.get_running_loop()
+    folder = folder or f"backup_{round(time.time())}"
+    os.mkdir(folder)
+    files = sorted([f for f in os.listdir(path) if f.endswith(".db") or f.endswith(".json")])
+    start = time.perf_counter()
+    size = 0
+    done = 0
+    with ThreadPoolExecutor(max_workers=self.workers) as executor:
+      await asyncio.gather(*[loop.run_in_executor(executor, db.flush) for db in databases if db.is_open])
+      tasks = []
+      for file_name in files:
+        if file_name.endswith(".db"):
+          method, target = self.backup_file, os.path.join(folder, f"{file_name}.gz")
+        else:
+          method, target = shutil.copyfile, os.path.join(folder, file_name)
+        tasks.append(loop.run_in_executor(executor, method, os.path.join(path, file_name), target))
+      for task in asyncio.as_completed(tasks):
+        result = await task
+        size += result if isinstance(result, int) else os.path.getsize(result)
+        done += 1
+        if progress is not None:
+          await progress(done, len(files))
+    logger.info(f"Backed up {len(files)} file(s) to {folder} in {time.perf_counter()-start:.1f}s ({size/2**20:.1f} MiB).")
+    return folder, size
+
+  async def restore(self, db, folder):
+    # restores a database from the backup folder
+    source = os.path.join(folder, f"{os.path.basename(db.name)}.gz")
+    if not os.path.isfile(source):
+      raise FileNotFoundError(f"there is no backup of {os.path.basename(db.name)} in {folder}.")
+    start = time.perf_counter()
+    await db.aio.run(self.restore_file, source, db)
+    logger.info(f"Restored {db.name} from {folder} in {time.perf_counter()-start:.1f}s.")
@@ -0,0 +1,66 @@
+import time
+from collections import deque
+import logging
+
+logger = logging.getLogger(__name__)
+
+class MaintenanceScheduler:
+  # Maintains the databases of DatabaseMaps one after the other, see DatabaseManager.maintain.
+  # A database is maintained at most once per interval (s) and only if nothing was written to it for quiet (s).
+  # A tick spends at most tick_budget (s), a database that is not finished within time_budget (s) continues in its next turn.
+  # A file created without incremental auto vacuum is converted once, at most one per tick as VACUUM rewrites the whole file.
+  def __init__(self, *maps, interval=86400, quiet=600, time_budget=0.5, tick_budget=2.0):
+    self.maps = maps
+    self.interval = interval
+    self.quiet = quiet
+    self.time_budget = time_budget
+    self.tick_budget = tick_budget
+    self.queue = deque()
+    self.queued = set()
+    # the guilds of a shared database have the same file, the state is kept by file name
+    self.finished = {} # the time of the last finished maintenance
+    self.unfinished = {} # the stats before the first step of an unfinished maintenance
+    self.reports = {} # (time, stats before, stats after) of the last maintenance
+
+  def due(self, db, now):
+    return now - self.finished.get(db.name, 0) >= self.interval and now - db.last_write >= self.quiet
+
+  async def tick(self):
+    for i, db_map in enumerate(self.maps):
+      for key in list(db_map.keys()):
+        if (i, key) not in self.queued:
+          self.queued.add((i, key))
+          self.queue.append((i, key))
+    start = time.monotonic()
+    converted = False
+    for n in range(len(self.queue)):
+      if time.monotonic() - start >= self.tick_budget:
+        break
+      self.queue.rotate(-1)
+      i, key = self.queue[-1]
+      db = self.maps[i].databases[key] # do not count the maintenance as use of the database
+      if not self.due(db, time.time()):
+        continue
+      was_open = db.is_open
+      try:
+        if not converted:
+          convert_start = time.perf_counter()
+          converted = await db.aio.run(db.enable_incremental_vacuum)
+          if converted:
+            logger.info(f"Enabled incremental auto vacuum of {db.name} in {time.perf_counter()-convert_start:.3f}s.")
+        before, after = await db.aio.run(db.maintain, self.time_budget)
+      except Exception as e:
+        logger.error(f"{e.__class__.__name__} occurs when maintaining {db.name}: {e}")
+        self.finished[db.name] = time.time() # try again in the next interval
+        continue
+      finally:
+        if not was_open and db.is_idle():
+          db.close()
+      before = self.unfinished.pop(db.name, before)
+      self.reports[db.name] = (time.time(), before, after)
+      if after["free_pages"] > 0 or after["auto_vacuum"] != 2: # not converted yet, it is converted in a later tick
+        self.unfinished[db.name] = before
+        continue
+      self.finished[db.name] = time.time()
+      logger.info(f"Maintained {db.name}: {before['size']/2**20:.1f} MiB with {before['free_pages']} free pages before, "
+                  f"{after['size']/2**20:.1f} MiB with {after['free_pages']} free pages after.")
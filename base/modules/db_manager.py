@@ -4,7 +4,98 @@ except:
   import sqlite3
 import re
 import os
+import asyncio
+import functools
+import threading
+import queue
+import itertools
+import time
+from contextlib import contextmanager
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from base.modules.constants import DB_PATH as path
+from base.modules.db_profiler import QueryProfiler
+from base.modules.db_migration import MigrationRunner
+import logging
+try:
+  import resource
+except ImportError: # not available on Windows
+  resource = None
+
+logger = logging.getLogger(__name__)
+
+class Row(Mapping):
+  # A read only row that behaves like a dict, the column index is shared by all rows of a table.
+  __slots__ = ("_values",)
+  _index = {}
+
+  def __init__(self, values):
+    self._values = values
+
+  @classmethod
+  def for_columns(cls, _name, columns):
+    # creates the row class of a table
+    return type(f"{_name}_row", (cls,), {"__slots__":(), "__module__":__name__, "_index":{k:i for i,k in enumerate(columns)}})
+
+  def __getitem__(self, key):
+    return self._values[self._index[key]]
+
+  def __iter__(self):
+    return iter(self._index)
+
+  def __len__(self):
+    return len(self._index)
+
+  def __contains__(self, key):
+    return key in self._index
+
+  def values(self):
+    return self._values
+
+  def __repr__(self):
+    return repr(dict(self.items()))
+
+def compile_validator(columns):
+  # creates a function that checks the values of a row for the columns {name:type}, the type is a key of
+  # DatabaseManager.DBType or the declared type of an imported table, e.g. "int_not_null" or "INTEGER NOT NULL"
+  # the values are not converted, the affinity of the columns converts e.g. "1" to 1
+  checks = []
+  for i, (k, t) in enumerate(columns.items()):
+    t = t.lower()
+    if "int" in t:
+      checks.append((i, k, int, (int, bool), "int"))
+    elif "real" in t or "floa" in t or "doub" in t:
+      checks.append((i, k, float, (float, int, bool), "float"))
+  checks = tuple(checks)
+  def validate(args):
+    for i, k, convert, valid_types, type_name in checks:
+      v = args[i]
+      if v is None or type(v) in valid_types:
+        continue # do not check None type
+      try:
+        convert(v)
+      except (ValueError, TypeError, OverflowError):
+        raise TypeError(f"wrong type for column {k}: must be {type_name}")
+  return validate
+
+def open_file_limit(default=1024):
+  # the number of files the process can open, a database needs several, see DatabaseManager.file_descriptors
+  if resource is None:
+    return default
+  soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+  return default if soft == resource.RLIM_INFINITY else soft
+
+def fts_query(text):
+  # turns a search text into a FTS5 query, the words and "quoted phrases" must all match and word* matches a prefix
+  terms = []
+  for term in re.findall(r'"[^"]*"\*?|[^\s"]+', text):
+    prefix = term.endswith("*")
+    term = term.rstrip("*").strip('"')
+    if term:
+      terms.append('"' + term.replace('"', '""') + '"' + ("*" if prefix else ""))
+  if not terms:
+    raise ValueError("the search text has no words.")
+  return " ".join(terms)
 
 class DatabaseManager:
   allowed_chars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_"
@@ -20,14 +111,141 @@ class DatabaseManager:
     "blob": "blob",
     "blob_not_null":"blob NOT NULL",
   }
+  # thresholds of the write-behind queue: flush after so many statements or seconds
+  batch_size = 500
+  flush_interval = 5.0
+  # pragmas applied to every connection in order, WAL lets the readers run concurrently with the writer
+  profile = {
+    # takes effect for new files before journal_mode writes the header, existing files are converted by enable_incremental_vacuum
+    "auto_vacuum": "INCREMENTAL",
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 32*1024*1024, # bytes
+    "cache_size": -4000, # negative means KiB
+    "busy_timeout": 5000, # ms
+  }
+  # number of read-only connections per database, a reader waits at most reader_timeout (s) for a free one
+  # before it opens a temporary connection
+  pool_size = 2
+  reader_timeout = 1.0
+  # queries slower than this (s) are logged with their query plan
+  slow_query_threshold = 0.1
+  # the number of newest matches ranked by search
+  search_window = 10000
+  # the tables of the database without the full-text indexes of create_fts and their shadow tables
+  table_filter = (r"type='table' AND name NOT LIKE '%\_fts' ESCAPE '\' AND name NOT LIKE '%\_fts\_%' ESCAPE '\' "
+                  r"AND name NOT LIKE 'sqlite\_%' ESCAPE '\'")
+  # the number of pages freed by a step of maintain, and the number of rows per index sampled by ANALYZE
+  vacuum_pages = 256
+  analysis_limit = 1000
+  # the errors of a queued write caused by its values, a flush drops the write instead of the whole batch
+  row_errors = (sqlite3.IntegrityError, sqlite3.DataError, sqlite3.InterfaceError)
   
   #Manages a connection to a single database.
-  def __init__(self, _name):
+  def __init__(self, _name, profile=None, pool_size=None):
     self.name = _name
+    self.profile = dict(self.profile, **profile) if profile else dict(self.profile)
+    if pool_size is not None:
+      self.pool_size = pool_size
+    # the connection can be used by the worker thread of AsyncDatabase, the lock serializes the transactions
+    self.lock = threading.RLock()
+    # write-behind queue of (statement, values) and the tables that have pending writes
+    self.pending = []
+    self.pending_tables = set()
+    self.flush_timer = None
+    self.statements = {}
+    self.profiler = QueryProfiler(self.slow_query_threshold)
+    # time.time() of the last write, the maintenance waits for quiet periods
+    self.last_write = 0
+    # the readers in use, pool_lock guards the count and the exchange of the pool by close
+    self.borrowed_readers = 0
+    self.pool_lock = threading.Lock()
+    self._connection = None
     self.open()
 
+  @property
+  def connection(self):
+    # a closed database is opened again when it is used
+    if self._connection is None:
+      self.ensure_open()
+    return self._connection
+
+  @property
+  def is_open(self):
+    return self._connection is not None
+
+  @property
+  def borrowed(self):
+    # the number of readers in use, including the temporary ones
+    with self.pool_lock:
+      return self.borrowed_readers
+
+  @classmethod
+  def file_descriptors(cls):
+    # the writer and every reader open the database and its WAL file, the shared memory file is opened once
+    return 2*(1+cls.pool_size)+1
+
+  def ensure_open(self):
+    if self._connection is not None: # the readers of an open database do not wait for the lock
+      return
+    with self.lock:
+      if self._connection is None:
+        self.open()
+
   def open(self):
-    self.connection = sqlite3.connect(self.name)
+    self._connection = sqlite3.connect(self.name, check_same_thread=False)
+    self.apply_profile(self._connection)
+    self.prepare_connection(self._connection)
+    self.readers = queue.Queue()
+    for i in range(self.pool_size):
+      self.readers.put(self.connect_reader())
+
+  def connect_reader(self):
+    reader = sqlite3.connect(f"file:{self.name}?mode=ro", uri=True, check_same_thread=False)
+    self.apply_profile(reader, read_only=True)
+    self.prepare_connection(reader)
+    return reader
+
+  def prepare_connection(self, conn):
+    # called for every new connection, subclasses can set up temporary objects here
+    pass
+
+  def apply_profile(self, conn, read_only=False):
+    for key, value in self.profile.items():
+      if read_only and key in ("journal_mode", "auto_vacuum"):
+        continue # these modes are stored in the file and set by the writer
+      conn.execute(f"PRAGMA {key}={value}")
+
+  @contextmanager
+  def reader(self):
+    # borrow a read-only connection from the pool, if all readers stay in use for reader_timeout a temporary one is used
+    if self.pool_size <= 0:
+      with self.lock:
+        yield self.connection
+      return
+    self.ensure_open()
+    readers = self.readers
+    try:
+      conn = readers.get(timeout=self.reader_timeout)
+      temporary = False
+    except queue.Empty:
+      logger.warning(f"All {self.pool_size} readers of {self.name} are in use for {self.reader_timeout}s, using a temporary one.")
+      conn = self.connect_reader()
+      temporary = True
+    with self.pool_lock:
+      self.borrowed_readers += 1
+    try:
+      yield conn
+    finally:
+      with self.pool_lock:
+        self.borrowed_readers -= 1
+        if not temporary and readers is self.readers:
+          readers.put(conn)
+        else: # a temporary reader, or the database was closed while the reader was borrowed
+          conn.close()
+
+  def is_read_query(self, query):
+    return re.match(r"\s*(SELECT|WITH|EXPLAIN)\b", query, re.IGNORECASE) is not None
 
   def check_name(self, _name):
     if not _name[0].isalpha():
@@ -47,47 +265,170 @@ class DatabaseManager:
     values = ",".join([f"{k} {self.DBType[v] if v in self.DBType else v}" for k,v in kwargs.items()])
     primary_keys = ",".join([k for k in _primary_keys])
     try:
-      with self.connection as conn:
+      with self.lock, self.connection as conn:
         #print(f'CREATE TABLE IF NOT EXISTS {_name} ({values}, PRIMARY KEY({primary_keys}))')
         conn.execute(f'CREATE TABLE IF NOT EXISTS {_name} ({values}, PRIMARY KEY({primary_keys}))')
     except Exception:
       raise RuntimeError("the execution of `CREATE TABLE` failed.")
 
-  def insert_or_update(self, _name, _primary_keys, **kwargs):
+  def create_index(self, _name, _table, _columns, _unique=False):
     self.check_name(_name)
-    p_string = ",".join(["?" for i in range(len(kwargs))])
-    t_string = ",".join([k for k,v in kwargs.items()])
-    values_in = tuple([v for k,v in kwargs.items()])
-    update = ",".join([f"{k}=excluded.{k}" for k,v in kwargs.items() if k not in _primary_keys])
+    self.check_name(_table)
+    for k in _columns:
+      self.check_name(k)
     try:
-      with self.connection as conn:
-        conn.execute(f'INSERT INTO {_name}({t_string}) VALUES ({p_string}) ON CONFLICT({",".join(_primary_keys)}) DO UPDATE SET {update}', values_in)
+      with self.lock, self.connection as conn:
+        conn.execute(f'CREATE {"UNIQUE " if _unique else ""}INDEX IF NOT EXISTS {_name} ON {_table}({",".join(_columns)})')
+    except Exception:
+      raise RuntimeError("the execution of `CREATE INDEX` failed.")
+
+  def explain(self, query, params=()):
+    # the details of the query plan, e.g. ["SEARCH media USING INDEX ..."]
+    with self.reader() as conn:
+      return [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall()]
+
+  def record_query(self, statement, start, rows=0, params=()):
+    # adds the duration since start to the query statistics, a slow query is logged with its plan
+    duration = time.perf_counter()-start
+    if self.profiler.record(statement, duration, rows):
+      try:
+        plan = "\n  ".join(self.explain(statement, params))
+      except Exception as e:
+        plan = f"{e.__class__.__name__}: {e}"
+      logger.warning(f"Slow query on {self.name} ({duration*1000:.1f} ms): {statement}\n  {plan}")
+
+  def upsert_statement(self, _name, _primary_keys, _columns, _add=()):
+    # the values of the columns in _add are added to the values of an existing row
+    p_string = ",".join(["?" for i in range(len(_columns))])
+    t_string = ",".join(_columns)
+    update = ",".join([f"{k}={k}+excluded.{k}" if k in _add else f"{k}=excluded.{k}" for k in _columns if k not in _primary_keys])
+    if update:
+      return f'INSERT INTO {_name}({t_string}) VALUES ({p_string}) ON CONFLICT({",".join(_primary_keys)}) DO UPDATE SET {update}'
+    return f'INSERT INTO {_name}({t_string}) VALUES ({p_string}) ON CONFLICT({",".join(_primary_keys)}) DO NOTHING'
+
+  def insert_or_update(self, _name, _primary_keys, _delay=False, **kwargs):
+    key = ("UPSERT", _name, tuple(_primary_keys), tuple(kwargs))
+    statement = self.statements.get(key)
+    if statement is None:
+      self.check_name(_name)
+      statement = self.statements[key] = self.upsert_statement(_name, _primary_keys, list(kwargs.keys()))
+    values_in = tuple(kwargs.values())
+    self.last_write = time.time()
+    if _delay:
+      self.enqueue(_name, statement, values_in)
+      return
+    start = time.perf_counter()
+    try:
+      with self.lock, self.connection as conn:
+        rows = conn.execute(statement, values_in).rowcount
     except Exception:
       raise RuntimeError("the execution of `INSERT INTO` failed.")
+    self.record_query(statement, start, rows, values_in)
 
-  def delete_table(self, _name):
+  def insert_many(self, _name, _primary_keys, _columns, _rows, _add=()):
+    # upsert many rows with a single statement in one transaction
     self.check_name(_name)
+    for k in _columns:
+      self.check_name(k)
+    statement = self.upsert_statement(_name, _primary_keys, _columns, _add)
+    self.flush(_name)
+    self.last_write = time.time()
+    try:
+      with self.lock, self.connection as conn:
+        conn.executemany(statement, _rows)
+    except Exception:
+      raise RuntimeError("the execution of `INSERT INTO` failed.")
+
+  def enqueue(self, _name, statement, values):
+    # queue a write, it is executed with the other queued writes in a single transaction
+    with self.lock:
+      self.pending.append((statement, values))
+      self.pending_tables.add(_name)
+      if len(self.pending) >= self.batch_size:
+        self.flush()
+      elif self.flush_timer is None:
+        self.flush_timer = threading.Timer(self.flush_interval, self.timed_flush)
+        self.flush_timer.daemon = True
+        self.flush_timer.start()
+
+  def timed_flush(self):
+    try:
+      self.flush()
+    except Exception as e:
+      logger.error(f"{e.__class__.__name__} occurs when flushing {self.name}: {e}")
+
+  def flush(self, _name=None):
+    # execute all queued writes, if a table name is given only flush when the table has pending writes
+    # the check is done without the lock, so the reads of other tables do not wait for a running write
+    # pending_tables is cleared after the batch is written, a read of its tables waits for the lock until then
+    if (not self.pending_tables) if _name is None else (_name not in self.pending_tables):
+      return
+    with self.lock:
+      if _name is not None and _name not in self.pending_tables:
+        return
+      if self.flush_timer is not None:
+        self.flush_timer.cancel()
+        self.flush_timer = None
+      if not self.pending:
+        return
+      pending = self.pending
+      self.pending = []
+      try:
+        errors = self.execute_batch(pending)
+      except sqlite3.Error as e:
+        # e.g. the database is locked or the disk is full, the writes stay queued for the next flush
+        self.pending = pending + self.pending
+        raise RuntimeError(f"the execution of {len(pending)} queued writes failed: {e}")
+      self.pending_tables = set()
+      for statement, values, e in errors:
+        logger.error(f"{e.__class__.__name__} occurs when flushing `{statement}` with {values} to {self.name}, the write is dropped: {e}")
+
+  def execute_batch(self, pending):
+    # executes the writes in one transaction, if the values of a write are rejected the batch is rolled back
+    # and the writes are retried one by one, so that a bad row only drops itself. Returns the dropped writes.
     try:
       with self.connection as conn:
+        for statement, values in pending:
+          conn.execute(statement, values)
+      return []
+    except self.row_errors:
+      pass
+    errors = []
+    with self.connection as conn:
+      for statement, values in pending:
+        try:
+          conn.execute(statement, values)
+        except self.row_errors as e:
+          errors.append((statement, values, e))
+    return errors
+
+  def delete_table(self, _name):
+    self.check_name(_name)
+    self.flush()
+    try:
+      with self.lock, self.connection as conn:
+        conn.execute(f"DROP TABLE IF EXISTS {_name}_fts")
         conn.execute(f"DROP TABLE IF EXISTS {_name}")
     except Exception:
       raise RuntimeError("the execution of `DROP TABLE` failed.")
 
-  def delete_row(self, _name, _primary_keys, _values):
+  def delete_row(self, _name, _primary_keys, _values, _delay=False):
     if len(_primary_keys) != len(_values):
       if len(_primary_keys) > len(_values):
         raise KeyError("I'm missing some values for the primary keys.")
       elif len(_primary_keys) < len(_values):
         raise KeyError("I'm missing some keys for the passed values.")
-    self.check_name(_name)
-    for k in _primary_keys:
-      self.check_name(k)
-    condition = " AND ".join([f'{k}="{v}"' for k,v in zip(_primary_keys, _values)])
+    statement = self.key_statement("DELETE FROM", _name, _primary_keys)
+    self.last_write = time.time()
+    if _delay:
+      self.enqueue(_name, statement, tuple(_values))
+      return
+    self.flush(_name)
     try:
-      with self.connection as conn:
-        conn.execute(f"DELETE FROM {_name} WHERE {condition}")
+      with self.lock, self.connection as conn:
+        conn.execute(statement, tuple(_values))
     except Exception as e:
-      raise RuntimeError("the execution of `SELECT ALL` failed.")
+      raise RuntimeError("the execution of `DELETE` failed.")
 
   def select_one(self, _name, _primary_keys, _values):
     if len(_primary_keys) != len(_values):
@@ -95,64 +436,365 @@ class DatabaseManager:
         raise KeyError("I'm missing some values for the primary keys.")
       elif len(_primary_keys) < len(_values):
         raise KeyError("I'm missing some keys for the passed values.")
-    for k in _primary_keys:
-      self.check_name(k)
-    condition = " AND ".join([f'{k}="{v}"' for k,v in zip(_primary_keys, _values)])
+    statement = self.key_statement("SELECT * FROM", _name, _primary_keys)
+    self.flush(_name)
+    start = time.perf_counter()
     try:
-      with self.connection as conn:
-        #print(f"Select * FROM {_name} WHERE {condition}")
-        return conn.execute(f"Select * FROM {_name} WHERE {condition}").fetchone()
+      with self.reader() as conn:
+        result = conn.execute(statement, tuple(_values)).fetchone()
     except Exception:
       raise RuntimeError("the execution of `SELECT ONE` failed.")
+    self.record_query(statement, start, 0 if result is None else 1, tuple(_values))
+    return result
+
+  def key_statement(self, _action, _name, _primary_keys):
+    # the statements with bound parameters are cached per table, so sqlite can reuse the prepared statement
+    key = (_action, _name, tuple(_primary_keys))
+    if key not in self.statements:
+      self.check_name(_name)
+      for k in _primary_keys:
+        self.check_name(k)
+      condition = " AND ".join([f"{k}=?" for k in _primary_keys])
+      self.statements[key] = f"{_action} {_name} WHERE {condition}"
+    return self.statements[key]
 
   def select_all(self, _name):
     self.check_name(_name)
+    self.flush(_name)
     try:
-      with self.connection as conn:
+      with self.reader() as conn:
         return conn.execute(f"Select * FROM {_name}").fetchall()
     except Exception as e:
       raise RuntimeError("the execution of `SELECT ALL` failed.")
 
+  def batch_statement(self, _name, where=None):
+    # the rows with rowid after the first parameter, followed by the params of where and the batch size
+    return f"SELECT rowid,* FROM {_name} WHERE rowid>?" + (f" AND ({where})" if where else "") + " ORDER BY rowid LIMIT ?"
+
+  def select_batches(self, _name, where=None, params=(), batch_size=500):
+    # a generator of lists with at most batch_size rows in the order of the rowid
+    # a reader is only borrowed to fetch a batch, so the caller can await anything between the batches
+    self.check_name(_name)
+    statement = self.batch_statement(_name, where)
+    self.flush(_name)
+    last = float("-inf")
+    while True:
+      try:
+        with self.reader() as conn:
+          rows = conn.execute(statement, (last,)+tuple(params)+(batch_size,)).fetchall()
+      except sqlite3.Error:
+        raise RuntimeError("the execution of `SELECT` failed.")
+      if rows:
+        last = rows[-1][0]
+        yield [row[1:] for row in rows]
+      if len(rows) < batch_size:
+        return
+
+  def fts_source(self, _table):
+    # the table indexed by the full-text index of _table and the condition on its rows t of this database
+    return _table, ""
+
+  def create_fts(self, _table, _columns):
+    # a FTS5 index of the text columns, it stores no copy of the text and is kept in sync by triggers on the table
+    self.check_name(_table)
+    for k in _columns:
+      self.check_name(k)
+    table, condition = self.fts_source(_table)
+    fts = f"{table}_fts"
+    columns = ",".join(_columns)
+    new_values = ",".join([f"new.{k}" for k in _columns])
+    old_values = ",".join([f"old.{k}" for k in _columns])
+    self.flush()
+    try:
+      with self.lock, self.connection as conn:
+        exists = conn.execute("SELECT name FROM sqlite_master WHERE name=?", (fts,)).fetchone()
+        conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({columns}, content='{table}', content_rowid='rowid', "
+                     f"tokenize='unicode61 remove_diacritics 2')")
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN "
+                     f"INSERT INTO {fts}(rowid,{columns}) VALUES (new.rowid,{new_values}); END")
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN "
+                     f"INSERT INTO {fts}({fts},rowid,{columns}) VALUES ('delete',old.rowid,{old_values}); END")
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE ON {table} BEGIN "
+                     f"INSERT INTO {fts}({fts},rowid,{columns}) VALUES ('delete',old.rowid,{old_values}); "
+                     f"INSERT INTO {fts}(rowid,{columns}) VALUES (new.rowid,{new_values}); END")
+        if not exists: # index the rows already in the table
+          conn.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+    except Exception:
+      raise RuntimeError("the execution of `CREATE VIRTUAL TABLE` failed.")
+
+  def search(self, _table, _columns, _match, _limit=10):
+    # the rows matching the FTS5 query _match, best first by bm25, with a snippet of the matching text appended
+    table, condition = self.fts_source(_table)
+    fts = f"{table}_fts"
+    select = ",".join([f"t.{k}" for k in _columns])
+    join = f" JOIN {table} t ON t.rowid={fts}.rowid" if condition else ""
+    # bm25 costs about a microsecond per match, only the newest search_window matches are ranked
+    # so that common words stay fast in huge tables, the rows are joined for the best matches only
+    window = (f"SELECT {fts}.rowid AS id,rank,snippet({fts},-1,'**','**','...',16) AS snippet FROM {fts}{join} "
+              f"WHERE {fts} MATCH ?{condition} ORDER BY {fts}.rowid DESC LIMIT ?")
+    statement = (f"SELECT {select},b.snippet FROM (SELECT * FROM ({window}) ORDER BY rank LIMIT ?) b "
+                 f"JOIN {table} t ON t.rowid=b.id ORDER BY b.rank")
+    params = (_match, self.search_window, _limit)
+    self.flush(_table)
+    start = time.perf_counter()
+    try:
+      with self.reader() as conn:
+        result = conn.execute(statement, params).fetchall()
+    except sqlite3.OperationalError as e:
+      raise RuntimeError(f"the search failed: {e}")
+    self.record_query(statement, start, len(result), params)
+    return result
+
+  def flush_query(self, query):
+    # flush the queued writes before a statement using a table with pending writes, see flush
+    tables = self.pending_tables
+    if tables and not tables.isdisjoint(re.findall(r"\w+", query)):
+      self.flush()
+
   def query(self, query):
+    self.flush_query(query)
+    start = time.perf_counter()
+    if self.is_read_query(query):
+      try:
+        with self.reader() as conn:
+          result = conn.execute(query).fetchall()
+        self.record_query(query, start, len(result))
+        return result
+      except sqlite3.OperationalError:
+        pass # e.g. a CTE that writes, retry with the writer
+      except Exception:
+        raise RuntimeError("the execution of the query failed.")
+    result = None
+    self.last_write = time.time()
     try:
-      with self.connection as conn:
-        result = conn.execute(query)
+      with self.lock, self.connection as conn:
+        cursor = conn.execute(query)
         if re.search("(SELECT|Select|select)", query):
-          return result.fetchall()
+          result = cursor.fetchall()
     except Exception:
       raise RuntimeError("the execution of the query failed.")
+    self.record_query(query, start, cursor.rowcount if result is None else len(result))
+    return result
 
   def info(self, _table=None):
     if _table is None:
       try:
-        with self.connection as conn:
-          return conn.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
+        with self.lock, self.connection as conn:
+          return conn.execute(f"SELECT name FROM sqlite_master WHERE {self.table_filter}").fetchall()
       except Exception:
         raise RuntimeError(f"could not get info on database.")
     else:
       try:
-        with self.connection as conn:
+        with self.lock, self.connection as conn:
           return conn.execute(f"PRAGMA table_info('{_table}')").fetchall()
       except Exception:
         raise RuntimeError(f"could not get info to table {_table}.")
+
+  def checkpoint(self):
+    # move the content of the WAL file into the database file
+    with self.lock:
+      self.flush()
+      self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+  def stats(self):
+    # the size of the files (bytes) and the page counts of the database
+    with self.lock:
+      conn = self.connection
+      page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+      page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+      free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+      auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+    size = sum([os.path.getsize(f) for f in (self.name, f"{self.name}-wal") if os.path.isfile(f)])
+    # the free pages can only be returned to the file system with auto_vacuum 2 (INCREMENTAL)
+    return {"size":size, "page_size":page_size, "page_count":page_count, "free_pages":free_pages, "auto_vacuum":auto_vacuum}
+
+  def enable_incremental_vacuum(self):
+    # converts a file created without auto_vacuum, VACUUM rewrites the whole file once, returns False if it was converted before
+    with self.lock:
+      if self.connection.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return False
+      self.flush()
+      self.connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+      self.connection.execute("VACUUM")
+      return True
+
+  def maintain(self, time_budget=0.5):
+    # returns free pages to the file system in small steps, then updates the statistics of the query planner
+    # the lock is released between the steps, so the writes of the bot only wait for a single step
+    # stops after time_budget (s) and returns the stats before and after, the rest is done by the next call
+    start = time.perf_counter()
+    before = self.stats()
+    while before["auto_vacuum"] == 2 and time.perf_counter()-start < time_budget:
+      with self.lock:
+        if self.connection.execute("PRAGMA freelist_count").fetchone()[0] == 0:
+          break
+        # the pragma frees a page per result row
+        self.connection.execute(f"PRAGMA incremental_vacuum({self.vacuum_pages})").fetchall()
+    if time.perf_counter()-start < time_budget:
+      with self.lock:
+        conn = self.connection
+        conn.execute(f"PRAGMA analysis_limit={self.analysis_limit}")
+        if conn.execute("SELECT name FROM sqlite_master WHERE name='sqlite_stat1'").fetchone() is None:
+          conn.execute("ANALYZE")
+        else:
+          conn.execute("PRAGMA optimize")
+        conn.commit()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return before, self.stats()
+
+  def restore(self, source, pages=-1):
+    # replaces the content of the database by the database of the connection source, the queued writes are dropped
+    with self.lock:
+      self.pending = []
+      self.pending_tables = set()
+      try:
+        source.backup(self.connection, pages=pages, sleep=0)
+      except sqlite3.Error:
+        raise RuntimeError(f"could not restore {self.name}.")
+
   def close(self):
-    self.connection.close()
+    with self.lock:
+      if self._connection is None:
+        return
+      self.flush()
+      # never wait for the borrowed readers, they are closed when they are returned, see reader
+      with self.pool_lock:
+        readers = self.readers
+        self.readers = queue.Queue()
+      while not readers.empty():
+        readers.get_nowait().close()
+      self._connection.close()
+      self._connection = None
+
+class SharedDatabaseManager(DatabaseManager):
+  # Keeps the tables of all guilds in a single file. Every table has a guild_id column leading its primary key,
+  # a connection sees the rows of its guild through temporary views named like the tables of a guild database,
+  # so that queries written for a single guild database work without changes.
+  # The tables have the same columns in all guilds, the first guild creating a table defines them.
+  prefix = "shared_"
+
+  def prepare_connection(self, conn):
+    tables = conn.execute(f"SELECT name FROM sqlite_master WHERE {self.table_filter} AND name LIKE '{self.prefix}%'").fetchall()
+    for table in tables:
+      if table[0].startswith(self.prefix):
+        self.create_view(conn, table[0][len(self.prefix):])
+
+  def create_view(self, conn, _name):
+    table = f"{self.prefix}{_name}"
+    columns = conn.execute(f"PRAGMA table_info('{table}')").fetchall()
+    keys = [col[1] for col in sorted(columns, key=lambda col: col[5]) if col[5] > 0 and col[1] != "guild_id"]
+    columns = [col[1] for col in columns if col[1] != "guild_id"]
+    gid = self.guild_id
+    col_string = ",".join(columns)
+    new_string = ",".join([f"NEW.{k}" for k in columns])
+    set_string = ",".join([f"{k}=NEW.{k}" for k in columns])
+    condition = " AND ".join([f"guild_id={gid}"] + [f"{k}=OLD.{k}" for k in keys])
+    # writes through the view are redirected to the shared table by the triggers, dropping the view drops them
+    conn.execute(f"DROP VIEW IF EXISTS temp.{_name}")
+    conn.execute(f"CREATE TEMP VIEW {_name} AS SELECT {col_string} FROM {table} WHERE guild_id={gid}")
+    conn.execute(f"CREATE TEMP TRIGGER {_name}_insert INSTEAD OF INSERT ON {_name} BEGIN "
+                 f"INSERT INTO {table}(guild_id,{col_string}) VALUES ({gid},{new_string}); END")
+    conn.execute(f"CREATE TEMP TRIGGER {_name}_update INSTEAD OF UPDATE ON {_name} BEGIN "
+                 f"UPDATE {table} SET {set_string} WHERE {condition}; END")
+    conn.execute(f"CREATE TEMP TRIGGER {_name}_delete INSTEAD OF DELETE ON {_name} BEGIN "
+                 f"DELETE FROM {table} WHERE {condition}; END")
+
+  def for_each_connection(self, method):
+    # runs the method with the writer and all readers, it waits until the readers are returned to the pool
+    with self.lock:
+      method(self.connection)
+      readers = [self.readers.get() for i in range(self.pool_size)]
+      try:
+        for conn in readers:
+          method(conn)
+      finally:
+        for conn in readers:
+          self.readers.put(conn)
+
+  def create_table(self, _name, _primary_keys, **kwargs):
+    self.check_name(_name)
+    if "guild_id" in kwargs:
+      raise NameError("the name guild_id is reserved for the guild of a row.")
+    super().create_table(f"{self.prefix}{_name}", ["guild_id"] + list(_primary_keys), guild_id="int_not_null", **kwargs)
+    try:
+      self.for_each_connection(lambda conn: self.create_view(conn, _name))
+    except Exception:
+      raise RuntimeError("the execution of `CREATE VIEW` failed.")
+
+  def create_index(self, _name, _table, _columns, _unique=False):
+    # the index is shared by all guilds, it is led by the guild_id
+    super().create_index(f"{self.prefix}{_name}", f"{self.prefix}{_table}", ["guild_id"] + list(_columns), _unique)
+
+  def upsert_statement(self, _name, _primary_keys, _columns, _add=()):
+    # upsert does not work on views, the rows are written to the shared table directly
+    p_string = ",".join([str(self.guild_id)] + ["?" for k in _columns])
+    t_string = ",".join(["guild_id"] + list(_columns))
+    conflict = ",".join(["guild_id"] + list(_primary_keys))
+    update = ",".join([f"{k}={k}+excluded.{k}" if k in _add else f"{k}=excluded.{k}" for k in _columns if k not in _primary_keys])
+    if update:
+      return f'INSERT INTO {self.prefix}{_name}({t_string}) VALUES ({p_string}) ON CONFLICT({conflict}) DO UPDATE SET {update}'
+    return f'INSERT INTO {self.prefix}{_name}({t_string}) VALUES ({p_string}) ON CONFLICT({conflict}) DO NOTHING'
+
+  def delete_table(self, _name):
+    # the table is shared with other guilds, only the rows of this guild are deleted
+    self.check_name(_name)
+    self.flush()
+    if (f"{self.prefix}{_name}",) not in super().info():
+      return
+    try:
+      with self.lock, self.connection as conn:
+        conn.execute(f"DELETE FROM {self.prefix}{_name} WHERE guild_id={self.guild_id}")
+      self.for_each_connection(lambda conn: conn.execute(f"DROP VIEW IF EXISTS temp.{_name}"))
+    except Exception:
+      raise RuntimeError("the execution of `DROP TABLE` failed.")
+
+  def restore(self, source, pages=-1):
+    raise RuntimeError("a guild cannot be restored alone in the shared database.")
+
+  def batch_statement(self, _name, where=None):
+    # the rowid of the view is not the rowid of the shared table, the rows are selected from the table
+    columns = ",".join([col[1] for col in SharedDatabaseManager.info(self, _name)])
+    return (f"SELECT rowid,{columns} FROM {self.prefix}{_name} WHERE guild_id={self.guild_id} AND rowid>?"
+            + (f" AND ({where})" if where else "") + " ORDER BY rowid LIMIT ?")
+
+  def fts_source(self, _table):
+    # the index is shared by all guilds
+    return f"{self.prefix}{_table}", f" AND t.guild_id={self.guild_id}"
+
+  def info(self, _table=None):
+    if _table is None:
+      tables = super().info()
+      return [(table[0][len(self.prefix):],) for table in tables if table[0].startswith(self.prefix)]
+    columns = super().info(f"{self.prefix}{_table}")
+    return [col for col in columns if col[1] != "guild_id"]
 
 class Database(DatabaseManager):
-  def __init__(self, _identifier):
+  # if set, select returns Row objects sharing the column names of the table instead of a dict per row
+  compact_rows = True
+
+  def __init__(self, _identifier, profile=None, pool_size=None):
     if not os.path.isdir(path):
       os.mkdir(path)
-    super().__init__(f"{path}/data_{_identifier}.db")
+    super().__init__(self.file_name(_identifier), profile, pool_size)
     self.id = _identifier
     self.tables = {}
+    self.write_behind = set()
     try:
       self._import()
     except:
       pass
+    self.aio = AsyncDatabase(self)
+
+  def file_name(self, _identifier):
+    return f"{path}/data_{_identifier}.db"
 
   def __contains__(self, _name):
     return _name in self.tables
 
+  def set_write_behind(self, *tables):
+    # the writes to these tables are queued and flushed in batches, see DatabaseManager.enqueue
+    self.write_behind.update(tables)
+
   def _import(self):
     tables = super().info()
     for table in tables:
@@ -162,6 +804,7 @@ class Database(DatabaseManager):
         "primary_key":primary_keys,
         "columns":{col[1]:col[2] for col in columns}
       }
+      self.compile_table(table[0])
 
   def create_table(self, _name, _primary_keys, **kwargs):
     if type(_primary_keys) == str:
@@ -173,39 +816,79 @@ class Database(DatabaseManager):
       "primary_key":_primary_keys,
       "columns":kwargs
     }
+    self.compile_table(_name)
+
+  def compile_table(self, _name):
+    # the row class, the validator and the positions of the primary keys are reused for every row of the table
+    table = self.tables[_name]
+    table["row"] = Row.for_columns(_name, table["columns"])
+    table["validate"] = compile_validator(table["columns"])
+    table["key_index"] = [i for i,k in enumerate(table["columns"]) if k in table["primary_key"]]
+
+  def make_rows(self, _name, rows):
+    if self.compact_rows:
+      return list(map(self.tables[_name]["row"], rows))
+    columns = self.tables[_name]["columns"]
+    return [{k:v for k,v in zip(columns, row)} for row in rows]
 
   def insert_or_update(self, _name, *args):
-    try:
-      kwargs = {k:v for k,v in zip(self.tables[_name]["columns"].keys(), args)}
-    except KeyError:
+    table = self.tables.get(_name)
+    if table is None:
       raise LookupError(f" the table {_name} does not exist.")
-    expected_len = len(self.tables[_name]['columns'].keys())
+    expected_len = len(table["columns"])
     actual_len = len(args)
     if expected_len != actual_len:
       raise IndexError(f"I expected {expected_len} values in insert, but got {actual_len}.")
+    table["validate"](args)
+    super().insert_or_update(_name, table["primary_key"], _name in self.write_behind, **dict(zip(table["columns"], args)))
+    return " ".join([str(args[i]) for i in table["key_index"]])
+
+  def insert_many(self, _name, rows, add=()):
+    # the values of the columns in add are added to the existing rows instead of replacing them, e.g. counters
+    if _name not in self.tables:
+      raise LookupError(f" the table {_name} does not exist.")
+    for k in add:
+      if k not in self.tables[_name]["columns"] or k in self.tables[_name]["primary_key"]:
+        raise KeyError(f"the table {_name} does not have a column {k} to add to.")
+    rows = [tuple(row) for row in rows]
+    if not rows:
+      return 0
+    columns = list(self.tables[_name]["columns"].keys())
+    expected_len = len(columns)
+    validate = self.tables[_name]["validate"]
+    for row in rows:
+      if len(row) != expected_len:
+        raise IndexError(f"I expected {expected_len} values in insert, but got {len(row)}.")
+      validate(row)
+    super().insert_many(_name, self.tables[_name]["primary_key"], columns, rows, tuple(add))
+    return len(rows)
+
+  def create_fts(self, _table, *columns):
+    if _table not in self.tables:
+      raise LookupError(f"the table {_table} does not exist.")
+    for k in columns:
+      if k not in self.tables[_table]["columns"]:
+        raise KeyError(f"the table {_table} does not have a column {k}.")
+    super().create_fts(_table, columns)
+
+  def search(self, _table, text, limit=10):
+    # returns (row, snippet) of the best matches of the search text, see fts_query
+    if _table not in self.tables:
+      raise LookupError(f"the table {_table} does not exist.")
+    result = super().search(_table, list(self.tables[_table]["columns"]), fts_query(text), limit)
+    return list(zip(self.make_rows(_table, [row[:-1] for row in result]), [row[-1] for row in result]))
+
+  def check_types(self, _name, args):
     #Check if type matches the table
-    for (k,t),v in zip(self.tables[_name]["columns"].items(), args):
-      if v is None:
-        continue # do not check None type
-      if "int" in t:
-        try:
-          int(v)
-        except ValueError:
-          raise TypeError(f"wrong type for column {k}: must be int")
-      elif "real" in t:
-        try:
-          float(v)
-        except ValueError:
-          raise TypeError(f"wrong type for column {k}: must be float")
-      elif "txt" in t:
-        try:
-          str(v)
-        except ValueError:
-          raise TypeError(f"wrong type for column {k}: must be str")
-    super().insert_or_update(_name, self.tables[_name]["primary_key"], **kwargs)
-    pkeys = self.tables[_name]["primary_key"]
-    cols = self.tables[_name]["columns"].keys()
-    return " ".join([str(a) for c,a in zip(cols, args) if c in pkeys])
+    self.tables[_name]["validate"](args)
+
+  def create_index(self, _table, *columns, unique=False):
+    if _table not in self.tables:
+      raise LookupError(f"the table {_table} does not exist.")
+    for k in columns:
+      if k not in self.tables[_table]["columns"]:
+        raise KeyError(f"the table {_table} does not have a column {k}.")
+    super().create_index(f"idx_{_table}_{'_'.join(columns)}", _table, columns, unique)
 
   def delete_table(self, _name):
     super().delete_table(_name)
@@ -222,7 +905,7 @@ class Database(DatabaseManager):
       actual_len = len(_values)
       if expected_len != actual_len:
         raise IndexError(f"Expected {expected_len} values in delete_row, but got {actual_len}.")
-      result = super().delete_row(_name, self.tables[_name]["primary_key"], _values)
+      result = super().delete_row(_name, self.tables[_name]["primary_key"], _values, _name in self.write_behind)
     else:
       raise ValueError(f"Expected {expected_len} values in delete_row, but got 0.")
 
@@ -238,18 +921,36 @@ class Database(DatabaseManager):
         raise IndexError(f"Expected {expected_len} values in select, but got {actual_len}.")
       result = super().select_one(_name, self.tables[_name]["primary_key"], _values)
       if result is not None:
-        return {k:v for k,v in zip(self.tables[_name]["columns"], result)}
+        return self.make_rows(_name, (result,))[0]
     else:
       result = super().select_all(_name)
       if len(result) > 0:
-        tmp = []
-        for row in result:
-          tmp.append({k:v for k,v in zip(self.tables[_name]["columns"], row)})
-        return tmp
+        return self.make_rows(_name, result)
+
+  def is_idle(self):
+    # no queued writes, no running calls in the worker threads and no borrowed readers
+    return not self.pending and self.aio.active == 0 and self.borrowed == 0
 
   def close(self):
+    self.aio.close()
     super().close()
 
+  def restore(self, source, pages=-1):
+    super().restore(source, pages)
+    self.tables = {}
+    self._import()
+
+  def select_batches(self, _name, where=None, params=(), batch_size=500):
+    if _name not in self.tables:
+      raise LookupError(f"the table {_name} does not exist.")
+    for rows in super().select_batches(_name, where, params, batch_size):
+      yield self.make_rows(_name, rows)
+
+  def select_iter(self, _name, where=None, params=(), batch_size=500):
+    # streams the rows of a table, optionally filtered by a where clause with bound params
+    for rows in self.select_batches(_name, where, params, batch_size):
+      yield from rows
+
   def info(self, _name=None):
     if _name is None:
       tables = super().info()
@@ -264,10 +965,322 @@ class Database(DatabaseManager):
       return (f"Table: {_name}\n"
               f"```Columns:\n  {column_str}```")
 
+class SharedDatabase(Database, SharedDatabaseManager):
+  # A guild database stored in the shared file of all guilds, it has the same API as Database.
+  def __init__(self, _identifier, profile=None, pool_size=None):
+    self.guild_id = int(_identifier)
+    super().__init__(_identifier, profile, pool_size)
+
+  def file_name(self, _identifier):
+    return f"{path}/data_shared.db"
+
+class AsyncDatabase:
+  # Awaitable facade of a Database, every write runs in a dedicated worker thread of the database
+  # so that the disk I/O does not block the event loop. The writes of one database are executed in order,
+  # the reads run in a separate pool of threads using the read-only connections.
+  def __init__(self, database):
+    self.db = database
+    self.active = 0
+    # the threads are started on the first call, they are stopped when the database is closed
+    self.executor = None
+    self.read_executor = None
+
+  async def run(self, method, *args, **kwargs):
+    if self.executor is None:
+      self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"db_{self.db.id}")
+    return await self.run_in(self.executor, method, *args, **kwargs)
+
+  async def run_read(self, method, *args, **kwargs):
+    if self.read_executor is None:
+      self.read_executor = ThreadPoolExecutor(max_workers=max(self.db.pool_size, 1), thread_name_prefix=f"db_{self.db.id}_read")
+    return await self.run_in(self.read_executor, method, *args, **kwargs)
+
+  async def run_in(self, executor, method, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    self.active += 1
+    try:
+      return await loop.run_in_executor(executor, functools.partial(method, *args, **kwargs))
+    finally:
+      self.active -= 1
+
+  async def create_table(self, _name, _primary_keys, **kwargs):
+    return await self.run(self.db.create_table, _name, _primary_keys, **kwargs)
+
+  async def insert_or_update(self, _name, *args):
+    return await self.run(self.db.insert_or_update, _name, *args)
+
+  async def insert_many(self, _name, rows, add=()):
+    return await self.run(self.db.insert_many, _name, rows, add)
+
+  async def delete_table(self, _name):
+    return await self.run(self.db.delete_table, _name)
+
+  async def delete_row(self, _name, _values=None):
+    return await self.run(self.db.delete_row, _name, _values)
+
+  async def select(self, _name, _values=None):
+    return await self.run_read(self.db.select, _name, _values)
+
+  async def select_iter(self, _name, where=None, params=(), batch_size=500):
+    # an async generator of rows, every batch is fetched in a worker thread
+    batches = self.db.select_batches(_name, where, params, batch_size)
+    try:
+      while True:
+        rows = await self.run_read(next, batches, None)
+        if rows is None:
+          break
+        for row in rows:
+          yield row
+    finally:
+      batches.close()
+
+  async def search(self, _table, text, limit=10):
+    return await self.run_read(self.db.search, _table, text, limit)
+
+  async def query(self, query):
+    if self.db.is_read_query(query):
+      return await self.run_read(self.db.query, query)
+    return await self.run(self.db.query, query)
+
+  async def info(self, _name=None):
+    return await self.run(self.db.info, _name)
+
+  async def flush(self):
+    return await self.run(self.db.flush)
+
+  def close(self):
+    # wait for the pending calls before the connection is closed
+    if self.executor is not None:
+      self.executor.shutdown(wait=True)
+      self.executor = None
+    if self.read_executor is not None:
+      self.read_executor.shutdown(wait=True)
+      self.read_executor = None
+
+class DatabaseMap:
+  # Maps guild ids to their databases. A database is opened when it is accessed for the first time,
+  # the least recently used idle databases are closed if more than max_open are open.
+  # A closed database keeps its table info and is opened again on the next access.
+  # Without max_open, as many databases are kept open as their file descriptors fit into fd_budget,
+  # by default half of the files the process can open.
+  def __init__(self, max_open=None, factory=Database, fd_budget=None):
+    if max_open is None:
+      if fd_budget is None:
+        fd_budget = open_file_limit()//2
+      max_open = max(1, fd_budget//factory.file_descriptors())
+    self.max_open = max_open
+    self.factory = factory
+    self.databases = {}
+    self.counter = itertools.count()
+
+  def __getitem__(self, guild_id):
+    db = self.databases.get(guild_id)
+    if db is None:
+      db = self.factory(guild_id)
+      self.databases[guild_id] = db
+      opened = True
+    else:
+      opened = not db.is_open
+      db.ensure_open()
+    db.last_used = next(self.counter)
+    if opened:
+      self.evict()
+    return db
+
+  def __setitem__(self, guild_id, db):
+    self.databases[guild_id] = db
+    db.last_used = next(self.counter)
+    self.evict()
+
+  def __contains__(self, guild_id):
+    return guild_id in self.databases
+
+  def __iter__(self):
+    return iter(self.databases)
+
+  def __len__(self):
+    return len(self.databases)
+
+  def keys(self):
+    return self.databases.keys()
+
+  def values(self):
+    return self.databases.values()
+
+  def items(self):
+    return self.databases.items()
+
+  def evict(self):
+    open_dbs = [db for db in self.databases.values() if db.is_open]
+    if len(open_dbs) <= self.max_open:
+      return
+    open_dbs.sort(key=lambda db: getattr(db, "last_used", -1))
+    for db in open_dbs[:len(open_dbs)-self.max_open]:
+      if db.is_idle():
+        db.close()
+
+def benchmark_lookups(rows=1000000, lookups=100000):
+  # primary key lookups on a messages table, with the values interpolated into the query and with bound parameters
+  import random
+  import time
+  db = Database("benchmark")
+  db.delete_table("messages")
+  db.create_table("messages", "mid", mid="int", time="real", aid="int", cid="int", content="txt", embeds="txt", files="txt")
+  db.insert_many("messages", ((i, float(i), i%1000, i%50, f"message {i}", "[]", "[]") for i in range(rows)))
+  keys = [random.randrange(rows) for i in range(lookups)]
+  with db.reader() as conn:
+    start = time.perf_counter()
+    for k in keys:
+      conn.execute(f'Select * FROM messages WHERE mid="{k}"').fetchone()
+    interpolated = lookups/(time.perf_counter()-start)
+  start = time.perf_counter()
+  for k in keys:
+    db.select("messages", k)
+  bound = lookups/(time.perf_counter()-start)
+  print(f"select on {rows} rows: interpolated {interpolated:.0f}/s, bound {bound:.0f}/s")
+  db.delete_table("messages")
+  db.close()
+
+def benchmark_rows(rows=100000):
+  # memory allocated by a select of all rows of a messages table, with a dict per row and with compact rows
+  import time
+  import tracemalloc
+  db = Database("benchmark")
+  db.delete_table("messages")
+  db.create_table("messages", "mid", mid="int", time="real", aid="int", cid="int", content="txt", embeds="txt", files="txt")
+  db.insert_many("messages", ((i, float(i), i%1000, i%50, f"message {i}", "[]", "[]") for i in range(rows)))
+  for compact in (False, True):
+    db.compact_rows = compact
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = db.select("messages")
+    duration = time.perf_counter()-start
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"select of {len(result)} rows, {'compact rows' if compact else 'dicts'}: "
+          f"{size/2**20:.1f} MiB held, {peak/2**20:.1f} MiB peak, {duration*1000:.0f} ms")
+    del result
+  db.delete_table("messages")
+  db.close()
+
+def benchmark_upserts(rows=100000):
+  # throughput of Database.insert_or_update on the media and messages tables, written immediately and write-behind
+  import time
+  db = Database("benchmark")
+  tables = {
+    "messages": (dict(mid="int", time="real", aid="int", cid="int", content="txt", embeds="txt", files="txt"),
+                 lambda i: (i, float(i), i%1000, i%50, f"message {i}", "[]", "[]")),
+    "media": (dict(mid="int", time="real", aid="int", cid="int", media="txt", pos="int", suppress="int"),
+              lambda i: (i, float(i), i%1000, i%50, '["https://example.com/a.png"]', 1, 0)),
+  }
+  for name, (columns, make_row) in tables.items():
+    for delay in (False, True):
+      db.delete_table(name)
+      db.create_table(name, "mid", **columns)
+      db.write_behind.discard(name)
+      if delay:
+        db.set_write_behind(name)
+      n = rows if delay else rows//10 # every immediate upsert is a commit
+      data = [make_row(i) for i in range(n)]
+      start = time.perf_counter()
+      for row in data:
+        db.insert_or_update(name, *row)
+      db.flush()
+      print(f"insert_or_update {name} {'write-behind' if delay else 'immediate'}: {n/(time.perf_counter()-start):.0f} rows/s")
+    db.delete_table(name)
+  db.close()
+
+def benchmark_counters(users=50000):
+  # flush of the statistics of the active users, a select and an upsert per user and an additive upsert of all users
+  import time
+  db = Database("benchmark")
+  columns = dict(userid="int", total_messages="int", total_commands="int", total_words="int", total_reacts="int", reacts_to_own="int")
+  db.delete_table("user_statistics")
+  db.create_table("user_statistics", "userid", **columns)
+  db.insert_many("user_statistics", [(i, 1, 1, 1, 1, 1) for i in range(users)])
+  counts = [(i, 2, 1, 10, 1, 0) for i in range(users)]
+  start = time.perf_counter()
+  rows = []
+  for userid, *stat in counts:
+    prev = db.select("user_statistics", userid)
+    rows.append((userid,) + tuple(prev.values()[i+1]+stat[i] for i in range(5)))
+  db.insert_many("user_statistics", rows)
+  print(f"select and upsert: {(time.perf_counter()-start)*1000:.0f} ms for {users} users")
+  start = time.perf_counter()
+  db.insert_many("user_statistics", counts, add=list(columns)[1:])
+  print(f"additive upsert: {(time.perf_counter()-start)*1000:.0f} ms for {users} users")
+  assert db.select("user_statistics", 7)["total_words"] == 21
+  db.delete_table("user_statistics")
+  db.close()
+
+def benchmark_search(rows=1000000, searches=100):
+  # ranked full-text searches of a rare, a common and a prefix term in a messages table
+  import random
+  import time
+  random.seed(0)
+  words = [f"word{i}" for i in range(20000)]
+  weights = list(itertools.accumulate([1/(i+1) for i in range(len(words))])) # the frequency of the words follows a zipf distribution
+  db = Database("benchmark")
+  db.delete_table("messages")
+  db.create_table("messages", "mid", mid="int", time="real", aid="int", cid="int", content="txt", embeds="txt", files="txt")
+  db.create_fts("messages", "content")
+  db.profiler.threshold = float("inf") # do not log the searches of common words
+  start = time.perf_counter()
+  for i in range(0, rows, 100000):
+    db.insert_many("messages", [(j, float(j), j%1000, j%50, " ".join(random.choices(words, cum_weights=weights, k=12)), "[]", "[]")
+                                for j in range(i, min(rows, i+100000))])
+  print(f"inserted {rows} indexed rows in {time.perf_counter()-start:.1f}s")
+  for text in ("word15000", "word10", "word1", "word19*", '"word2 word3"'):
+    start = time.perf_counter()
+    for i in range(searches):
+      result = db.search("messages", text, 10)
+    print(f"search {text}: {(time.perf_counter()-start)/searches*1000:.1f} ms, {len(result)} results")
+  db.delete_table("messages")
+  db.close()
+
+def migrate_to_shared(guild_ids=None, migrations=None):
+  # copies the guild database files into the shared database, the guild files are kept
+  # the schema versions are not copied, the indexes of the guild files do not exist in the shared file yet,
+  # so the migrations (a MigrationRunner) are applied to the shared database after the import, or by the bot at its next start
+  if guild_ids is None:
+    guild_ids = [f[5:-3] for f in os.listdir(path) if re.fullmatch(r"data_\d+\.db", f)]
+  for guild_id in guild_ids:
+    source = Database(guild_id)
+    target = SharedDatabase(guild_id)
+    for table, table_info in source.tables.items():
+      if table == MigrationRunner.table:
+        continue
+      target.create_table(table, table_info["primary_key"], **table_info["columns"])
+      rows = source.query(f"SELECT {','.join(table_info['columns'])} FROM {table}")
+      target.insert_many(table, rows or [])
+      logger.info(f"Migrated {len(rows or [])} rows of table {table} in guild {guild_id}.")
+      # the full-text index of the table, the shadow tables of the guild file are not copied
+      fts = source.query(f"SELECT name FROM sqlite_master WHERE name='{table}_fts'")
+      if fts:
+        columns = [col[1] for col in DatabaseManager.info(source, f"{table}_fts")]
+        target.create_fts(table, *columns)
+    if migrations is not None:
+      migrations.migrate(target)
+    source.close()
+    target.close()
+
 if __name__ == "__main__":
-  db = Database("stats", [])
-  db.create_table("hero", "name", name="txt_not_null", hp="int")
-  db.insert_or_update("hero", "leif", 1000)
-  db.insert_or_update("hero", "fee", 500)
-  print(db.info())
-  print(db.info("hero"))
+  # run from the root folder: python -m base.modules.db_manager [benchmark]...
+  # or copy the guild databases into the shared database: python -m base.modules.db_manager migrate [guild_id]...
+  import sys
+  benchmarks = {
+    "lookups": benchmark_lookups,
+    "rows": benchmark_rows,
+    "upserts": benchmark_upserts,
+    "counters": benchmark_counters,
+    "search": benchmark_search,
+  }
+  if sys.argv[1:2] == ["migrate"]:
+    logging.basicConfig(level=logging.INFO)
+    migrate_to_shared(sys.argv[2:] or None)
+  else:
+    import tempfile
+    # the benchmark databases are created in a temporary folder, not among the databases of the bot
+    with tempfile.TemporaryDirectory() as path:
+      for name in sys.argv[1:] or benchmarks.keys():
+        benchmarks[name]()
@@ -0,0 +1,83 @@
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Migration:
+  # a step of the database schema, apply is called with a Database in a worker thread
+  # apply has to be idempotent, a step interrupted before its version is stored runs again at the next start
+  def __init__(self, version, description, apply):
+    self.version = version
+    self.description = description
+    self.apply = apply
+
+class MigrationRunner:
+  # applies the ordered migrations to the guild databases, the version of a database is stored in its schema_version table
+  table = "schema_version"
+
+  def __init__(self, batch_size=16):
+    self.migrations = {}
+    self.batch_size = batch_size
+
+  def add(self, version, description, apply):
+    if type(version) != int or version <= 0:
+      raise ValueError("the version of a migration must be a positive integer.")
+    if version in self.migrations:
+      raise KeyError(f"the migration {version} already exists.")
+    self.migrations[version] = Migration(version, description, apply)
+
+  def migration(self, version, description):
+    # a decorator to add a function as migration
+    def decorator(apply):
+      self.add(version, description, apply)
+      return apply
+    return decorator
+
+  @property
+  def latest(self):
+    return max(self.migrations, default=0)
+
+  def version(self, db):
+    if self.table not in db:
+      db.create_table(self.table, "version", version="int", description="txt", applied="real", duration="real")
+    rows = db.select(self.table)
+    return max([row["version"] for row in rows]) if rows else 0
+
+  def migrate(self, db):
+    # applies the pending migrations to a database, returns the duration of each applied migration
+    durations = {}
+    current = self.version(db)
+    for version in sorted([v for v in self.migrations if v > current]):
+      migration = self.migrations[version]
+      start = time.perf_counter()
+      migration.apply(db)
+      durations[version] = time.perf_counter()-start
+      db.insert_or_update(self.table, version, migration.description, time.time(), durations[version])
+      logger.debug(f"Applied migration {version} to {db.name} in {durations[version]:.3f}s.")
+    return durations
+
+  async def migrate_all(self, databases):
+    # migrates the databases in batches, every database runs the migrations in its own worker thread
+    # returns the databases that failed, their remaining migrations are retried at the next call
+    start = time.perf_counter()
+    durations = {}
+    failed = []
+    databases = list(databases)
+    for i in range(0, len(databases), self.batch_size):
+      batch = databases[i:i+self.batch_size]
+      results = await asyncio.gather(*[db.aio.run(self.migrate, db) for db in batch], return_exceptions=True)
+      for db, result in zip(batch, results):
+        if isinstance(result, Exception):
+          logger.error(f"{result.__class__.__name__} occurs when migrating {db.name}: {result}")
+          failed.append(db)
+          continue
+        for version, duration in result.items():
+          durations.setdefault(version, []).append(duration)
+    for version, times in sorted(durations.items()):
+      logger.info(f"Migration {version} ({self.migrations[version].description}) applied to {len(times)} database(s) "
+                  f"in {sum(times):.3f}s, the slowest took {max(times):.3f}s.")
+    if durations or failed:
+      logger.info(f"Migrated {len(databases)-len(failed)} of {len(databases)} database(s) to version {self.latest} "
+                  f"in {time.perf_counter()-start:.3f}s.")
+    return failed
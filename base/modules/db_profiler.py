@@ -0,0 +1,82 @@
+import re
+import threading
+from collections import deque
+
+class QueryStats:
+  # the timings of all queries with the same normalized statement
+  __slots__ = ("statement", "count", "total", "max", "rows", "samples")
+
+  def __init__(self, statement, samples=512):
+    self.statement = statement
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+    self.rows = 0
+    # the latest durations for the percentiles
+    self.samples = deque(maxlen=samples)
+
+  def add(self, duration, rows):
+    self.count += 1
+    self.total += duration
+    self.rows += rows
+    if duration > self.max:
+      self.max = duration
+    self.samples.append(duration)
+
+  def percentile(self, p):
+    samples = sorted(self.samples)
+    if not samples:
+      return 0.0
+    return samples[min(len(samples)-1, int(p/100*len(samples)))]
+
+  def __repr__(self):
+    return (f"{self.count}x {self.statement}: p50 {self.percentile(50)*1000:.2f} ms, "
+            f"p95 {self.percentile(95)*1000:.2f} ms, max {self.max*1000:.2f} ms, {self.rows} rows")
+
+class QueryProfiler:
+  # Collects the timings of the queries of a database grouped by statement shape.
+  # The literals are replaced by ? so that e.g. all lookups of a message share the same QueryStats.
+  literal_re = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|(?<![\w.])-?\d+(?:\.\d+)?")
+  list_re = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+  space_re = re.compile(r"\s+")
+
+  def __init__(self, threshold=0.1, max_shapes=1024):
+    # queries slower than threshold (s) are reported by record
+    self.threshold = threshold
+    self.max_shapes = max_shapes
+    self.stats = {}
+    self.shapes = {}
+    self.lock = threading.Lock()
+
+  def normalize(self, statement):
+    shape = self.shapes.get(statement)
+    if shape is None:
+      shape = self.literal_re.sub("?", statement)
+      shape = self.list_re.sub("(?,...)", shape)
+      shape = self.space_re.sub(" ", shape).strip()
+      if len(self.shapes) >= self.max_shapes:
+        self.shapes.clear()
+      self.shapes[statement] = shape
+    return shape
+
+  def record(self, statement, duration, rows=0):
+    # returns True if the query is slower than the threshold
+    shape = self.normalize(statement)
+    with self.lock:
+      stats = self.stats.get(shape)
+      if stats is None:
+        if len(self.stats) >= self.max_shapes:
+          return duration > self.threshold # do not track more shapes, e.g. queries with unusual literals
+        stats = self.stats[shape] = QueryStats(shape)
+      stats.add(duration, rows)
+    return duration > self.threshold
+
+  def top(self, n=10, key=lambda stats: stats.total):
+    # the statement shapes that took the most time in total
+    with self.lock:
+      stats = list(self.stats.values())
+    return sorted(stats, key=key, reverse=True)[:n]
+
+  def reset(self):
+    with self.lock:
+      self.stats = {}
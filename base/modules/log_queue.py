@@ -0,0 +1,75 @@
+import asyncio
+import inspect
+from collections import deque
+import discord
+import logging
+
+logger = logging.getLogger(__name__)
+
+# discord.py sends several embeds in a message from version 2.0, the older versions send them one by one
+supports_embeds = "embeds" in inspect.signature(discord.abc.Messageable.send).parameters
+
+class LogQueue:
+  # Sends the log embeds of a channel in the background, so that the caller does not wait for Discord.
+  # The embeds queued within delay (s) are packed into messages of up to 10 embeds and 6000 characters,
+  # an embed with a file is sent in its own message. The messages are sent one after the other,
+  # so a burst uses a single request at a time and the rate limits are handled by the HTTP client of discord.py.
+  max_embeds = 10
+  max_length = 6000
+
+  def __init__(self, channel, delay=1.0):
+    self.channel = channel
+    self.delay = delay
+    self.entries = deque()
+    self.task = None
+    self.flushing = asyncio.Event()
+
+  def put(self, embed, file=None):
+    self.entries.append((embed, file))
+    if self.task is None or self.task.done():
+      self.task = asyncio.ensure_future(self.run())
+
+  def next_batch(self):
+    embed, file = self.entries.popleft()
+    embeds = [embed]
+    if file is not None:
+      return embeds, file
+    length = len(embed)
+    while self.entries and len(embeds) < self.max_embeds:
+      embed, file = self.entries[0]
+      if file is not None or length+len(embed) > self.max_length:
+        break
+      self.entries.popleft()
+      embeds.append(embed)
+      length += len(embed)
+    return embeds, None
+
+  async def send(self, embeds, file=None):
+    if file is not None:
+      await self.channel.send(embed=embeds[0], file=file)
+    elif supports_embeds:
+      await self.channel.send(embeds=embeds)
+    else:
+      for embed in embeds:
+        await self.channel.send(embed=embed)
+
+  async def run(self):
+    try:
+      await asyncio.wait_for(self.flushing.wait(), self.delay) # collect the burst
+    except asyncio.TimeoutError:
+      pass
+    while self.entries:
+      embeds, file = self.next_batch()
+      try:
+        await self.send(embeds, file)
+      except Exception as e:
+        logger.error(f"{e.__class__.__name__} occurs when sending {len(embeds)} log(s) to {self.channel} ({self.channel.id}): {e}")
+
+  async def flush(self, timeout=None):
+    # waits until the queued embeds are sent
+    if self.task is not None and not self.task.done():
+      self.flushing.set()
+      try:
+        await asyncio.wait_for(asyncio.shield(self.task), timeout)
+      finally:
+        self.flushing.clear()
@@ -4,6 +4,7 @@ import asyncio
 import json
 import os
 import inspect
+from collections.abc import Mapping
 import discord
 from discord.ext import commands
 from base.modules.constants import num_emojis, CACHE_PATH as path
@@ -53,7 +54,7 @@ async def message_to_row(message):
     message.channel.id, message.content, embeds, files)
     
 def get_message_from_row(row, bot, guild):
-  if isinstance(row, dict):
+  if isinstance(row, Mapping):
     row = row.values()
   mid, ctime, aid, cid, content, embeds, files = row
   ctime = seconds_to_date_string(ctime)
@@ -101,7 +102,7 @@ def get_full_message(row, bot, guild):
   return text, embed_post, files_post
   
 def clean_message_files(row):
-  if isinstance(row, dict):
+  if isinstance(row, Mapping):
     files = row["files"]
   else:
     files = row[-1]
@@ -193,6 +194,11 @@ async def multiple_choice(context, content, timeout=30.0, *, num:int=None, emoji
 async def save_message(bot, message):
   # ensure the synchronization of this method
   row = await message_to_row(message)
-  bot.db[message.channel.guild.id].insert_or_update("messages", *row)
+  await bot.db[message.channel.guild.id].aio.insert_or_update("messages", *row)
+  
+async def save_messages(bot, guild, messages):
+  # save many messages with a single bulk insert
+  rows = [await message_to_row(message) for message in messages]
+  return await bot.db[guild.id].aio.insert_many("messages", rows)
   
   
@@ -0,0 +1,40 @@
+class NameIndex:
+  # The roles and channels of the guilds that the bot finds by name, e.g. the role named by MOD_ROLE_NAME or the mod-log.
+  # The first lookup of a key scans the guild, the result (also None) is kept until the roles or channels of the guild change.
+  def __init__(self):
+    self.roles = {}
+    self.channels = {}
+
+  def lookup(self, index, guild_id, key, scan):
+    entries = index.get(guild_id)
+    if entries is None:
+      entries = index[guild_id] = {}
+    try:
+      return entries[key]
+    except KeyError:
+      value = entries[key] = scan()
+      return value
+
+  def get_role(self, guild_id, key, scan):
+    return self.lookup(self.roles, guild_id, key, scan)
+
+  def get_channel(self, guild_id, key, scan):
+    return self.lookup(self.channels, guild_id, key, scan)
+
+  def invalidate_roles(self, guild_id):
+    self.roles.pop(guild_id, None)
+
+  def invalidate_channels(self, guild_id):
+    self.channels.pop(guild_id, None)
+
+  def invalidate_key(self, guild_id, key):
+    self.roles.get(guild_id, {}).pop(key, None)
+    self.channels.get(guild_id, {}).pop(key, None)
+
+  def clear(self, guild_id=None):
+    if guild_id is None:
+      self.roles = {}
+      self.channels = {}
+    else:
+      self.invalidate_roles(guild_id)
+      self.invalidate_channels(guild_id)
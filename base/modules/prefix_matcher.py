@@ -0,0 +1,79 @@
+import re
+
+class PrefixMatcher:
+  # The command prefixes of a guild compiled into one regex, see BaseBot.is_command.
+  # Like BaseBot.find_prefix, the first of the prefixes that starts a message is the prefix of the message.
+  def __init__(self, prefixes):
+    if isinstance(prefixes, str):
+      prefixes = [prefixes]
+    self.prefixes = tuple(prefixes)
+    # the alternatives of a regex are tried in order
+    self.regex = re.compile("|".join([re.escape(prefix) for prefix in self.prefixes])) if self.prefixes else None
+
+  def find(self, content):
+    if self.regex is None:
+      return None
+    match = self.regex.match(content)
+    return None if match is None else match.group(0)
+
+  def is_command(self, content):
+    if not content: #ignore empty message
+      return False
+    prefix = self.find(content)
+    if prefix is None:
+      return False
+    if len(prefix) == 0: # no prefix is required
+      return True
+    # multiple prefixes, i.e. the prefix followed by its last character like ??, are not counted as a command
+    return not content.startswith(prefix[-1], len(prefix))
+
+def benchmark_is_command(guilds=1000, messages=200000):
+  # messages per second through is_command with the prefixes of 1000 guilds,
+  # with the regex of the prefix built for every message and with a precompiled matcher per guild
+  import random
+  import time
+  bot_id = 730000000000000000
+  prefixes = {}
+  for i in range(guilds):
+    role_id = 740000000000000000+i
+    prefixes[i] = [random.choice(["?", "!", "$", ".", "%", ">>", "pls "]), f"<@&{role_id}> ", f"<@{bot_id}> ", f"<@!{bot_id}> "]
+  samples = []
+  for i in range(messages):
+    guild = random.randrange(guilds)
+    prefix = random.choice(prefixes[guild])
+    content = random.choice([f"{prefix}help", f"{prefix}{prefix}", "hello there", "what is the prefix here?"])
+    samples.append((guild, content))
+  def is_command(guild, content):
+    if not content:
+      return False
+    prefix = None
+    for pre in prefixes[guild]:
+      if content.startswith(pre):
+        prefix = pre
+        break
+    if prefix is None:
+      return False
+    if len(prefix) == 0:
+      return True
+    prefix_match = re.match(f"({re.escape(prefix)}+)", content)
+    return prefix_match is not None and len(prefix_match.group(0))/len(prefix) == 1
+  matchers = {}
+  def is_command_matcher(guild, content):
+    matcher = matchers.get(guild)
+    if matcher is None or matcher.prefixes != tuple(prefixes[guild]):
+      matcher = matchers[guild] = PrefixMatcher(prefixes[guild])
+    return matcher.is_command(content)
+  for name, check in (("regex per message", is_command), ("precompiled", is_command_matcher)):
+    start = time.perf_counter()
+    commands = sum([check(guild, content) for guild, content in samples])
+    duration = time.perf_counter()-start
+    print(f"{name}: {messages/duration:.0f} messages/s, {commands} commands")
+
+if __name__ == "__main__":
+  # run from the root folder: python -m base.modules.prefix_matcher [benchmark]...
+  import sys
+  benchmarks = {
+    "is_command": benchmark_is_command,
+  }
+  for name in sys.argv[1:] or benchmarks.keys():
+    benchmarks[name]()
@@ -1,13 +1,18 @@
 import inspect
 from base.modules.db_manager import Database
+import logging
+
+logger = logging.getLogger(__name__)
 
 class DefaultSetting:
   # a class to store a default setting
   # transFun is a function to transform the value of a setting from string to something else
   # checkFun is a function to check the validity of a setting, it must return a boolean
   # adaptFun is a function to adapt the setting to the new value in the bot, it takes two arguments: value and context
-  def __init__(self, name, default, description="", transFun=None, checkFun=None, checkDescription="", adaptFun=None):
+  # persist stores the default in every guild, for defaults that can change like the names derived from the bot name
+  def __init__(self, name, default, description="", transFun=None, checkFun=None, checkDescription="", adaptFun=None, persist=False):
     self.name = name
+    self.persist = persist
     self.description = description
     self.transFun = transFun
     self.checkFun = checkFun
@@ -51,59 +56,264 @@ class DefaultSetting:
     return value
 
 
+class SettingsBus:
+  # Calls the listeners of a setting with (guild_id, key, value) when the transformed value changes in a guild,
+  # so that the cogs can keep state derived from the settings instead of reading them on every event.
+  def __init__(self):
+    self.listeners = {}
+
+  def __contains__(self, key):
+    return key in self.listeners
+
+  def subscribe(self, key, callback):
+    self.listeners.setdefault(key, []).append(callback)
+
+  def unsubscribe(self, key, callback):
+    if callback in self.listeners.get(key, []):
+      self.listeners[key].remove(callback)
+      if not self.listeners[key]:
+        del self.listeners[key]
+
+  def publish(self, guild_id, key, value):
+    for callback in list(self.listeners.get(key, [])):
+      try:
+        callback(guild_id, key, value)
+      except Exception as e:
+        logger.error(f"{e.__class__.__name__} occurs in a listener of {key} in {guild_id}: {e}")
+
+class SettingsSubscriber:
+  # A mixin of the cogs that read settings on every event. The transformed values of subscribed_settings are kept
+  # in guild_settings by the settings bus of the bot, see BaseBot.subscribe_setting.
+  # The cog calls subscribe_settings in __init__ and unsubscribe_settings in cog_unload.
+  subscribed_settings = []
+
+  def subscribe_settings(self):
+    self.guild_settings = {}
+    self.bot.subscribe_setting(self.update_setting, *self.subscribed_settings)
+
+  def unsubscribe_settings(self):
+    self.bot.unsubscribe_setting(self.update_setting, *self.subscribed_settings)
+
+  def update_setting(self, guild_id, key, value):
+    self.guild_settings.setdefault(guild_id, {})[key] = value
+
+  def get_guild_setting(self, guild, key):
+    try:
+      return self.guild_settings[guild.id][key]
+    except KeyError: # the guild is not initialized yet
+      return self.bot.get_setting(guild, key)
+
 class Settings:
+  # The settings of a guild. Only the settings added to the guild and the default settings with a changed value
+  # or description are stored, the others are read from defaults, a dict of DefaultSetting shared by all guilds.
 
-  def __init__(self, database, **kwargs):
+  # The changes of the values are published to bus, a SettingsBus shared by all guilds.
+
+  def __init__(self, database, defaults=None, bus=None, **kwargs):
     self.db = database
     self.id = self.db.id
+    self.defaults = defaults if defaults is not None else {}
+    self.bus = bus if bus is not None else SettingsBus()
     self.db.create_table("bot_settings", "name", name="txt", value="txt", description="txt")
     
-    # load the db content to memory
+    # load the db content to memory, the listeners receive the initial values
+    self.memory = None
     self.load_memory()
+    for key, setting in self.defaults.items():
+      if setting.persist and key not in self.memory:
+        self.store(key, setting.default, setting.description)
     for key, value in kwargs.items():
-      if key in self.memory:
+      if key in self:
         self.set(key, value)
 
   def __contains__(self, key):
-    return key in self.memory
+    return key in self.memory or key in self.defaults
     
   def load_memory(self):
+    old_values = {} if self.memory is None else {key: self.transformed(key) for key in self.bus.listeners if key in self}
     self.memory = {}
+    # the values transformed by their DefaultSetting, see get_value
+    self.values = {}
     result = self.db.select("bot_settings")
     if result is not None:
       for row in result:
         self.memory[row["name"]] = [row["value"], row["description"]]
+    for key in list(self.bus.listeners):
+      if key in self and (key not in old_values or self.transformed(key) != old_values[key]):
+        self.bus.publish(self.id, key, self.transformed(key))
+
+  def is_default(self, key, value, description):
+    setting = self.defaults.get(key)
+    if setting is None or setting.persist or description != setting.description:
+      return False
+    try:
+      return setting.transform_setting(value) == setting.default
+    except Exception:
+      return False
+
+  def store(self, key, value, description):
+    # writes the setting, a default setting is deleted instead if it has the default value and description
+    old_value = self.transformed(key) if key in self.bus and key in self else None
+    if self.is_default(key, value, description):
+      if key in self.memory:
+        self.db.delete_row("bot_settings", key)
+        self.memory.pop(key)
+    else:
+      self.db.insert_or_update("bot_settings", key, value, description)
+      self.memory[key] = [value, description]
+    self.values.pop(key, None)
+    self.changed(key, old_value)
+
+  def changed(self, key, old_value):
+    if key in self.bus and key in self and self.transformed(key) != old_value:
+      self.bus.publish(self.id, key, self.transformed(key))
 
   def get(self, key):
-    if key not in self.memory:
-      raise LookupError(f"{key} does not exist.")
-    return self.memory[key][0]
+    if key in self.memory:
+      return self.memory[key][0]
+    if key in self.defaults:
+      return self.defaults[key].default
+    raise LookupError(f"{key} does not exist.")
+
+  def get_description(self, key):
+    if key in self.memory:
+      return self.memory[key][1]
+    if key in self.defaults:
+      return self.defaults[key].description
+    raise LookupError(f"{key} does not exist.")
+
+  def get_value(self, key, default_setting=None):
+    # the value transformed by default_setting, it is cached until the setting changes
+    try:
+      return self.values[key]
+    except KeyError:
+      pass
+    value = self.get(key)
+    if default_setting is not None:
+      try:
+        value = default_setting.transform_setting(value)
+      except:
+        value = default_setting.default
+    self.values[key] = value
+    return value
+
+  def transformed(self, key):
+    return self.get_value(key, self.defaults.get(key))
 
   def set(self, key, value):
-    if key not in self.memory:
-      raise LookupError(f"{key} does not exist.")
-    self.db.insert_or_update("bot_settings", key, value, self.memory[key][1])
-    self.memory[key][0] = value
+    self.store(key, value, self.get_description(key))
 
   def add(self, key, value):
-    if key in self.memory:
+    if key in self:
       raise LookupError(f"{key} already exists.")
-    self.db.insert_or_update("bot_settings", key, value, "no description")
-    self.memory[key] = [value, "no description"]
+    self.store(key, value, "no description")
 
   def add_description(self, key, value):
-    if key not in self.memory:
+    if key not in self:
       raise LookupError(f"{key} does not exists.")
-    self.db.insert_or_update("bot_settings", key, self.memory[key][0], value)
-    self.memory[key][1] = value
+    self.store(key, self.get(key), value)
 
   def rm(self, key):
-    if key not in self.memory:
-      raise LookupError(f"t{key} does not exist.")
-    self.db.delete_row("bot_settings", key)
-    self.memory.pop(key, None)
+    # a removed default setting returns to its default value
+    if key not in self:
+      raise LookupError(f"{key} does not exist.")
+    old_value = self.transformed(key) if key in self.bus else None
+    if key in self.memory:
+      self.db.delete_row("bot_settings", key)
+      self.memory.pop(key)
+    self.values.pop(key, None)
+    self.changed(key, old_value)
+
+  def compact(self):
+    # deletes the stored default settings that have the default value and description, returns their number
+    keys = [key for key, (value, description) in self.memory.items() if self.is_default(key, value, description)]
+    if keys:
+      # a single statement instead of a commit per row
+      names = ",".join(["'" + key.replace("'", "''") + "'" for key in keys])
+      self.db.query(f"DELETE FROM bot_settings WHERE name IN ({names})")
+    for key in keys:
+      self.memory.pop(key)
+      self.values.pop(key, None)
+    return len(keys)
 
   def info(self):
-    max_len = max([len(k) for k in self.memory])+2
-    setting_str = "\n".join([f"{k+':':<{max_len}}{v[1]}" for k,v in self.memory.items()])
+    keys = list(self.defaults) + [k for k in self.memory if k not in self.defaults]
+    max_len = max([len(k) for k in keys])+2
+    setting_str = "\n".join([f"{k+':':<{max_len}}{self.get_description(k)}" for k in keys])
     return f"Possible Settings:\n{setting_str}"
+
+def benchmark_lookups(guilds=100, messages=100000):
+  # the setting lookups of a guild message (prefix, log switch and media suppression), transformed on every call and cached
+  import random
+  import time
+  default_settings = {setting.name: setting for setting in [
+    DefaultSetting(name="PREFIX", default="?"),
+    DefaultSetting(name="MESSAGE_LOG", default="ON", transFun=lambda x: x.upper()),
+    DefaultSetting(name="SUPPRESS_MODE", default="OFF", transFun=lambda x: x.upper()),
+    DefaultSetting(name="SUPPRESS_FILTER", default="LIGHT", transFun=lambda x: x.upper()),
+    DefaultSetting(name="SUPPRESS_CHANNEL", default="ALL_BUT_WHITE", transFun=lambda x: x.upper()),
+    DefaultSetting(name="SUPPRESS_DELAY", default=10.0, transFun=lambda x: float(x)),
+    DefaultSetting(name="SUPPRESS_POSITION", default=10, transFun=lambda x: int(x)),
+    DefaultSetting(name="SUPPRESS_LIMIT", default=5, transFun=lambda x: int(x)),
+    DefaultSetting(name="MEDIA_RATE_LIMIT", default=10, transFun=lambda x: int(x)),
+  ]}
+  settings = []
+  for i in range(guilds):
+    db = Database(f"benchmark_{i}")
+    db.delete_table("bot_settings")
+    settings.append(Settings(db))
+    for key, setting in default_settings.items():
+      settings[-1].add(key, str(setting.default))
+  order = [random.choice(settings) for i in range(messages)]
+  def transformed(guild_settings, key):
+    return default_settings[key].transform_setting(guild_settings.get(key))
+  def cached(guild_settings, key):
+    return guild_settings.get_value(key, default_settings[key])
+  for name, lookup in (("transformed", transformed), ("cached", cached)):
+    start = time.perf_counter()
+    for guild_settings in order:
+      for key in default_settings:
+        lookup(guild_settings, key)
+    duration = time.perf_counter()-start
+    print(f"{name}: {duration/messages*1e6:.2f} us per message, {messages/duration:.0f} messages/s")
+  for guild_settings in settings:
+    guild_settings.db.delete_table("bot_settings")
+    guild_settings.db.close()
+
+def benchmark_init(guilds=100, keys=30):
+  # initialization of the settings of a new guild, with every default setting stored and with the defaults shared
+  import time
+  defaults = {f"KEY_{i}": DefaultSetting(name=f"KEY_{i}", default=i, description=f"setting {i}", transFun=lambda x: int(x))
+              for i in range(keys)}
+  dbs = [Database(f"benchmark_{i}") for i in range(guilds)]
+  for name in ("stored", "shared"):
+    for db in dbs:
+      db.delete_table("bot_settings")
+    start = time.perf_counter()
+    for db in dbs:
+      if name == "stored":
+        settings = Settings(db)
+        for key, setting in defaults.items():
+          settings.add(key, setting.default)
+          settings.add_description(key, setting.description)
+      else:
+        Settings(db, defaults)
+    duration = time.perf_counter()-start
+    print(f"{name}: {duration/guilds*1000:.2f} ms per guild")
+  for db in dbs:
+    db.delete_table("bot_settings")
+    db.close()
+
+if __name__ == "__main__":
+  # run from the root folder: python -m base.modules.settings_manager [benchmark]...
+  import sys
+  import tempfile
+  from base.modules import db_manager
+  benchmarks = {
+    "lookups": benchmark_lookups,
+    "init": benchmark_init,
+  }
+  # the benchmark databases are created in a temporary folder, not among the databases of the bot
+  with tempfile.TemporaryDirectory() as db_manager.path:
+    for name in sys.argv[1:] or benchmarks.keys():
+      benchmarks[name]()
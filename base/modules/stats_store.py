@@ -0,0 +1,170 @@
+import os
+import asyncio
+import struct
+from array import array
+import logging
+
+logger = logging.getLogger(__name__)
+
+class StatsCounters:
+  # The statistics of the users of a guild since the last flush to the user_statistics table.
+  # A user has a row in one typed array per counter, so a user costs a few words instead of a dict with string keys.
+  # Every adjustment is appended to the journal file before it is counted, the journal is replayed when the counters
+  # are created again, e.g. after a crash, and it is emptied by flush.
+  fields = ("messages", "commands", "words", "reactions", "reacts_to_own")
+  # user id and the deltas of the counters
+  record = struct.Struct("<q5i")
+
+  def __init__(self, journal=None):
+    self.journal = journal
+    self.index = {} # user id -> row
+    self.users = array("q")
+    self.counts = [array("q") for field in self.fields]
+    self.file = None
+    # a flush rotates the journal, the next flush waits until it is finished
+    self.flush_lock = asyncio.Lock()
+    if journal is not None:
+      self.recover()
+
+  def __len__(self):
+    return len(self.users)
+
+  def __contains__(self, user_id):
+    return user_id in self.index
+
+  def get(self, user_id):
+    # the counts of the user as dict, None if the user has no counts
+    row = self.index.get(user_id)
+    if row is None:
+      return None
+    return {field: counts[row] for field, counts in zip(self.fields, self.counts)}
+
+  def count(self, user_id, deltas):
+    row = self.index.get(user_id)
+    if row is None:
+      row = self.index[user_id] = len(self.users)
+      self.users.append(user_id)
+      for counts in self.counts:
+        counts.append(0)
+    for counts, delta in zip(self.counts, deltas):
+      counts[row] += delta
+
+  def adjust(self, user_id, *deltas):
+    if self.file is not None:
+      # an unbuffered write, the record is kept by the OS even if the process is killed
+      self.file.write(self.record.pack(user_id, *deltas))
+    self.count(user_id, deltas)
+
+  def rows(self):
+    # (user id, counts...) of the users with changed counts
+    return [(user_id,) + tuple(counts[row] for counts in self.counts)
+            for row, user_id in enumerate(self.users) if any(counts[row] for counts in self.counts)]
+
+  def clear(self):
+    self.index = {}
+    self.users = array("q")
+    self.counts = [array("q") for field in self.fields]
+
+  def replay(self, file_name):
+    with open(file_name, "rb") as f:
+      data = f.read()
+    size = len(data)-len(data)%self.record.size # a record torn by a crash is ignored
+    for user_id, *deltas in self.record.iter_unpack(data[:size]):
+      self.count(user_id, deltas)
+    return size//self.record.size
+
+  def write_journal(self):
+    # replaces the journal by a record of the current counts per user
+    tmp = f"{self.journal}.tmp"
+    with open(tmp, "wb") as f:
+      f.write(b"".join([self.record.pack(*row) for row in self.rows()]))
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(tmp, self.journal)
+
+  def recover(self):
+    # a journal being flushed was not written to the database when the bot stopped
+    folder = os.path.dirname(self.journal)
+    if folder and not os.path.isdir(folder):
+      os.mkdir(folder)
+    records = 0
+    for file_name in (f"{self.journal}.flushing", self.journal):
+      if os.path.isfile(file_name):
+        records += self.replay(file_name)
+    if records:
+      logger.info(f"Replayed {records} statistics of {len(self)} users from {self.journal}.")
+    self.write_journal()
+    if os.path.isfile(f"{self.journal}.flushing"):
+      os.remove(f"{self.journal}.flushing")
+    self.file = open(self.journal, "ab", buffering=0)
+
+  async def flush(self, write):
+    # await write(rows) stores the counts, the counters start from zero before, so they can be adjusted meanwhile.
+    # If write fails the counts are added again. A crash after write and before the journal is removed
+    # counts the flushed statistics again at the next start.
+    async with self.flush_lock:
+      rows = self.rows()
+      if self.file is not None:
+        self.file.close()
+        os.replace(self.journal, f"{self.journal}.flushing")
+        self.file = open(self.journal, "ab", buffering=0)
+      self.clear()
+      try:
+        if rows:
+          await write(rows)
+      except:
+        for user_id, *counts in rows:
+          self.adjust(user_id, *counts)
+        raise
+      finally:
+        if os.path.isfile(f"{self.journal}.flushing"):
+          os.remove(f"{self.journal}.flushing")
+      return len(rows)
+
+  def close(self):
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+
+def benchmark_memory(users=1000000):
+  # memory of the counts of a huge guild, with a dict per user and with StatsCounters, and the throughput of adjust
+  import time
+  import tracemalloc
+  for name in ("dict", "arrays"):
+    tracemalloc.start()
+    if name == "dict":
+      stats = {}
+      for user_id in range(users):
+        stats[user_id] = {"messages":1,"commands":0,"words":5,"reactions":0,"reacts_to_own":0,"change":True}
+    else:
+      stats = StatsCounters()
+      for user_id in range(users):
+        stats.adjust(user_id, 1, 0, 5, 0, 0)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"{name}: {size/2**20:.1f} MiB for {users} users")
+    del stats
+  journal = "benchmark_stats.journal"
+  stats = StatsCounters(journal)
+  start = time.perf_counter()
+  for i in range(users):
+    stats.adjust(i%10000, 1, 0, 5, 0, 0)
+  print(f"adjust with journal: {users/(time.perf_counter()-start):.0f} adjustments/s")
+  stats.close()
+  start = time.perf_counter()
+  stats = StatsCounters(journal)
+  print(f"replay: {(time.perf_counter()-start)*1000:.0f} ms for {users} adjustments of {len(stats)} users")
+  async def write(rows):
+    pass
+  asyncio.run(stats.flush(write))
+  stats.close()
+  os.remove(journal)
+
+if __name__ == "__main__":
+  # run from the root folder: python -m base.modules.stats_store [benchmark]...
+  import sys
+  benchmarks = {
+    "memory": benchmark_memory,
+  }
+  for name in sys.argv[1:] or benchmarks.keys():
+    benchmarks[name]()
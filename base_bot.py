@@ -2,7 +2,6 @@ import random
 import traceback
 import time
 import json
-import re
 import sys
 from datetime import datetime
 
@@ -10,25 +9,53 @@ import discord
 from discord.ext import commands
 
 from base.modules.custom_commands import add_cmd_from_row
-from base.modules.db_manager import Database
-from base.modules.settings_manager import Settings
+from base.modules.db_manager import DatabaseMap, Database, SharedDatabase, open_file_limit
+from base.modules.db_migration import MigrationRunner
+from base.modules.db_archive import MessageArchive
+from base.modules.settings_manager import Settings, SettingsBus
 from base.modules.settings_manager import DefaultSetting
-from base.modules.constants import games, animes
+from base.modules.name_index import NameIndex
+from base.modules.log_queue import LogQueue
+from base.modules.prefix_matcher import PrefixMatcher
+from base.modules.stats_store import StatsCounters
+from base.modules.constants import games, animes, CACHE_PATH as cache_path
 
 import logging
 
 logger = logging.getLogger("base.base_bot")
 
 class BaseBot(commands.Bot):
+  # the settings that name the roles of the bot
+  role_settings = ["MOD_ROLE_NAME", "ADMIN_ROLE_NAME", "BOT_ROLE_NAME", "CMD_ROLE_NAME", "MUTE_ROLE_NAME"]
 
-  def __init__(self, *arg, **kwargs):
+  def __init__(self, *arg, max_open_databases=None, shared_database=False, **kwargs):
     super().__init__(*arg, **kwargs)
     self.intialized = {}
-    self.db = {}
-    self.user_stats = {}
+    # guild databases are opened on first access, idle ones are closed above max_open_databases
+    # by default the open databases use half of the file limit and the archives an eighth, the rest is left for the sockets
+    # with shared_database all guilds are stored in one file, see SharedDatabase
+    file_limit = open_file_limit()
+    self.db = DatabaseMap(max_open=max_open_databases, factory=SharedDatabase if shared_database else Database, fd_budget=file_limit//2)
+    # the old saved messages of the guilds, see ARCHIVE_AGE
+    self.archives = DatabaseMap(max_open=max_open_databases, factory=MessageArchive, fd_budget=file_limit//8)
+    self.user_stats = {} # guild id -> StatsCounters, see get_user_stats
     self.settings = {}
     self.invites = {}
     self.default_settings = {}
+    # the listeners of setting changes in all guilds, see subscribe_setting
+    self.setting_bus = SettingsBus()
+    # the bot roles, the bot category and the logs of the guilds, see find_role and find_channel
+    self.names = NameIndex()
+    # channel id -> LogQueue, the logs are sent in the background
+    self.log_queues = {}
+    # guild id (None for DMs) -> PrefixMatcher of the prefixes of the guild
+    self.prefix_matchers = {}
+    self.setting_bus.subscribe("BOT_CATEGORY_NAME", self.on_name_setting)
+    for setting_name in self.role_settings:
+      self.setting_bus.subscribe(setting_name, self.on_name_setting)
+    # the schema changes of the guild databases, they are applied before a guild is initialized
+    self.migrations = MigrationRunner()
+    self.initialize_migrations()
     @self.check # add a global check to the bot
     def check_initialized(context):
       if context.guild.id not in context.bot.intialized or not context.bot.intialized[context.guild.id]:
@@ -44,14 +71,15 @@ class BaseBot(commands.Bot):
       logger.debug(f"Finished command: {context.command.qualified_name}.")
 
   async def find_prefix(self, message):
-    prefix = await self.get_prefix(message)
-    if isinstance(prefix, (list, tuple)):
-      for pre in prefix:
-        if message.content.startswith(pre):
-          return pre
-      else:
-        return None
-    return prefix
+    return self.get_prefix_matcher(message.guild, await self.get_prefix(message)).find(message.content)
+
+  def get_prefix_matcher(self, guild, prefixes):
+    # the matcher is compiled again only when the prefixes of the guild change, e.g. by the PREFIX setting
+    key = guild.id if guild else None
+    matcher = self.prefix_matchers.get(key)
+    if matcher is None or matcher.prefixes != (tuple(prefixes) if isinstance(prefixes, (list, tuple)) else (prefixes,)):
+      matcher = self.prefix_matchers[key] = PrefixMatcher(prefixes)
+    return matcher
 
   def get_channel(self, guild, **kwargs):
     return discord.utils.get(guild.text_channels, **kwargs)
@@ -123,31 +151,26 @@ class BaseBot(commands.Bot):
       if key and value:
         embed.add_field(name=f"{key}:", value=f"{value}", inline=False)
     embed.set_footer(text=log_type.replace("_", " "))
-    if log_type == "MOD_LOG":
-      await self.get_log(guild, "mod-log").send(embed=embed, file=file)
-    elif log_type == "ADMIN_LOG":
-      await self.get_log(guild, "admin-log").send(embed=embed, file=file)
-    elif log_type == "ERROR_LOG":
-      await self.get_log(guild, "error-log").send(embed=embed, file=file)
-    elif log_type == "AUDIT_LOG":
-      await self.get_log(guild, "audit-log").send(embed=embed, file=file)
-    elif log_type == "MESSAGE_LOG":
-      await self.get_log(guild, "message-log").send(embed=embed, file=file)
+    channel = self.get_log(guild, log_type.lower().replace("_", "-"))
+    if channel is None:
+      logger.warning(f"The {log_type} of {guild.name} ({guild.id}) does not exist.")
+      return
+    # the embed is sent in the background together with the other logs of the channel, see LogQueue
+    queue = self.log_queues.get(channel.id)
+    if queue is None:
+      queue = self.log_queues[channel.id] = LogQueue(channel)
+    queue.channel = channel
+    queue.put(embed, file)
 
   def get_setting(self, guild, setting_name):
+    # the transformed value is cached by the Settings of the guild until the setting changes
+    default_setting = self.default_settings.get(setting_name)
     try:
-      value = self.settings[guild.id].get(setting_name)
+      return self.settings[guild.id].get_value(setting_name, default_setting)
     except Exception as e:
-      if setting_name in self.default_settings:
-        value = self.default_settings[setting_name].default
-      else:
-        raise e
-    if setting_name in self.default_settings:
-      try:
-        value = self.default_settings[setting_name].transform_setting(value)
-      except:
-        value = self.default_settings[setting_name].default
-    return value
+      if default_setting is not None:
+        return default_setting.default
+      raise e
 
   async def set_setting(self, guild, setting_name, value, context=None):
     # type check and adapt the settings in the bot's guild if there is a change in settings db
@@ -169,17 +192,28 @@ class BaseBot(commands.Bot):
   def rm_setting(self, guild, setting_name):
     self.settings[guild.id].rm(setting_name)
 
+  def subscribe_setting(self, callback, *setting_names):
+    # callback(guild_id, setting_name, value) receives the transformed value of the settings of the initialized guilds now,
+    # then of every guild when it is initialized and whenever the value changes
+    for setting_name in setting_names:
+      self.setting_bus.subscribe(setting_name, callback)
+      for guild_id, settings in self.settings.items():
+        if setting_name in settings:
+          callback(guild_id, setting_name, settings.transformed(setting_name))
+
+  def unsubscribe_setting(self, callback, *setting_names):
+    for setting_name in setting_names:
+      self.setting_bus.unsubscribe(setting_name, callback)
+
 
   async def init_bot(self, guild):
     if guild.me.nick is None:
       await guild.me.edit(nick="A Bot")
-    if guild.id not in self.db:
-      self.db[guild.id] = Database(guild.id)
-    if guild.id not in self.user_stats:
-      self.user_stats[guild.id] = {}
+    # replays the statistics that were not flushed before the bot stopped
+    self.get_user_stats(guild)
     if guild.id not in self.settings:
-      self.settings[guild.id] = Settings(self.db[guild.id])
-      self.add_default_settings(guild)
+      # the default settings are not stored in the guild database, see Settings
+      self.settings[guild.id] = Settings(self.db[guild.id], self.default_settings, self.setting_bus)
     await self.create_roles(guild)
     await self.create_logs(guild)
     self.create_tables(guild)
@@ -226,38 +260,55 @@ class BaseBot(commands.Bot):
         except Exception as e:
           logger.warning(f"{e.__class__.__name__} occurs when adding command {cmd['cmdname']}: {e}")
           
+  def get_archive(self, guild):
+    # the message archive of the guild or None if no message was archived yet
+    if guild.id in self.archives or MessageArchive.exists(guild.id):
+      return self.archives[guild.id]
+    return None
+
   def get_guild_prefix(self, guild):
     return self.get_setting(guild, "PREFIX")
 
+  def find_role(self, guild, setting_name):
+    # the role named by the setting, the scan of guild.roles is cached until the roles change
+    return self.names.get_role(guild.id, setting_name,
+      lambda: discord.utils.get(guild.roles, name=self.get_setting(guild, setting_name)))
+
+  def find_channel(self, guild, key, scan):
+    # the channel found by scan, it is cached until the channels change
+    return self.names.get_channel(guild.id, key, scan)
+
+  def on_name_setting(self, guild_id, setting_name, value):
+    self.names.invalidate_key(guild_id, setting_name)
+    if setting_name == "BOT_CATEGORY_NAME": # the logs are found in the bot category
+      self.names.invalidate_channels(guild_id)
+
   def get_log(self, guild, name):
-    bot_category = self.get_bot_category(guild)
-    if bot_category is None:
-      return None
-    return discord.utils.get(bot_category.text_channels, name=name)
+    def scan():
+      bot_category = self.get_bot_category(guild)
+      if bot_category is None:
+        return None
+      return discord.utils.get(bot_category.text_channels, name=name)
+    return self.find_channel(guild, f"log:{name}", scan)
 
   def get_mod_role(self, guild):
-    name = self.get_setting(guild, "MOD_ROLE_NAME")
-    return discord.utils.get(guild.roles, name=name)
+    return self.find_role(guild, "MOD_ROLE_NAME")
     
   def get_admin_role(self, guild):
-    name = self.get_setting(guild, "ADMIN_ROLE_NAME")
-    return discord.utils.get(guild.roles, name=name)
+    return self.find_role(guild, "ADMIN_ROLE_NAME")
 
   def get_bot_role(self, guild):
-    name = self.get_setting(guild, "BOT_ROLE_NAME")
-    return discord.utils.get(guild.roles, name=name)
+    return self.find_role(guild, "BOT_ROLE_NAME")
 
   def get_cmd_role(self, guild):
-    name = self.get_setting(guild, "CMD_ROLE_NAME")
-    return discord.utils.get(guild.roles, name=name)
+    return self.find_role(guild, "CMD_ROLE_NAME")
 
   def get_mute_role(self, guild):
-    name = self.get_setting(guild, "MUTE_ROLE_NAME")
-    return discord.utils.get(guild.roles, name=name)
+    return self.find_role(guild, "MUTE_ROLE_NAME")
 
   def get_bot_category(self, guild):
-    name = self.get_setting(guild, "BOT_CATEGORY_NAME")
-    return discord.utils.get(guild.categories, name=name)
+    return self.find_channel(guild, "BOT_CATEGORY_NAME",
+      lambda: discord.utils.get(guild.categories, name=self.get_setting(guild, "BOT_CATEGORY_NAME")))
 
   async def set_random_status(self):
     n = random.randint(0,1)
@@ -266,24 +317,18 @@ class BaseBot(commands.Bot):
     elif n == 1:
       await self.change_presence(activity=discord.Activity(type=discord.ActivityType.watching, name=random.choice(animes)))
 
-  def update_user_stats(self, guild):
+  def get_user_stats(self, guild):
+    # the statistics since the last update, they are journaled in the cache folder
+    counters = self.user_stats.get(guild.id)
+    if counters is None:
+      counters = self.user_stats[guild.id] = StatsCounters(f"{cache_path}/stats_{guild.id}.journal")
+    return counters
+
+  async def update_user_stats(self, guild):
+    # the counts are added to the stored totals by the upsert, a single statement for all users in a worker thread
     db = self.db[guild.id]
-    for userid, stat in self.user_stats[guild.id].items():
-      if stat["change"] is True:
-        prev = db.select("user_statistics", userid)
-        if prev is None:
-          db.insert_or_update("user_statistics", userid,
-                              stat["messages"], stat["commands"], stat["words"],
-                              stat["reactions"], stat["reacts_to_own"])
-        else:
-          db.insert_or_update("user_statistics", userid,
-                              prev["total_messages"]+stat["messages"],
-                              prev["total_commands"]+stat["commands"],
-                              prev["total_words"]+stat["words"],
-                              prev["total_reacts"]+stat["reactions"],
-                              prev["reacts_to_own"]+stat["reacts_to_own"]
-          )
-    self.user_stats[guild.id] = {}#clear stats
+    await self.get_user_stats(guild).flush(lambda rows: db.aio.insert_many("user_statistics", rows,
+      add=("total_messages", "total_commands", "total_words", "total_reacts", "reacts_to_own")))
 
   #This global command error handler just adds the embed to the error log.
   #Any additional stuff should be done before calling this handler from the subclass.
@@ -358,8 +403,11 @@ class BaseBot(commands.Bot):
       self.db[guild.id].create_table("user_commands", "cmdname", cmdname="txt", message="txt", attributes="txt", isgroup="int_not_null", lock="int_not_null", glob="int_not_null", perm="txt")
     if "messages" not in self.db[guild.id]:
       self.db[guild.id].create_table("messages", "mid", mid="int", time="real", aid="int", cid="int", content="txt", embeds="txt", files="txt")
+      self.db[guild.id].create_fts("messages", "content")
     if "media" not in self.db[guild.id]:
       self.db[guild.id].create_table("media", "mid", mid="int", time="real", aid="int", cid="int", media="txt", pos="int", suppress="int")
+    # the writes of these busy tables are batched, the queue is flushed when the bot closes
+    self.db[guild.id].set_write_behind("messages", "media", "user_statistics")
 
 
   async def create_logs(self, guild):
@@ -571,26 +619,34 @@ class BaseBot(commands.Bot):
           pass
 
   async def on_guild_channel_create(self, channel):
+    self.names.invalidate_channels(channel.guild.id)
     await self.set_mute_channel_permission(channel.guild, [channel])
 
+  async def on_guild_channel_delete(self, channel):
+    self.names.invalidate_channels(channel.guild.id)
+
+  async def on_guild_channel_update(self, before, after):
+    if before.name != after.name or before.category_id != after.category_id:
+      self.names.invalidate_channels(after.guild.id)
+
+  async def on_guild_role_create(self, role):
+    self.names.invalidate_roles(role.guild.id)
+
+  async def on_guild_role_delete(self, role):
+    self.names.invalidate_roles(role.guild.id)
+
+  async def on_guild_role_update(self, before, after):
+    # e.g. a reorder updates every role, only a new name changes the result of a lookup
+    if before.name != after.name:
+      self.names.invalidate_roles(after.guild.id)
+
   def adjust_user_stats(self, guild, user, msg, cmd, wrd, rct, own):
     if hasattr(user, "id"):
       id = user.id
     else: #passed an id directly
       id = user
-    if guild.id not in self.user_stats:
-      self.user_stats[guild.id] = {}
-    user_stats = self.user_stats[guild.id]
-    if id not in user_stats:
-      user_stats[id] = {"messages":0,"commands":0,"words":0,"reactions":0,"reacts_to_own":0,"change":False}
-    stats = user_stats[id]
-    stats["messages"] += msg
-    stats["commands"] += cmd
-    stats["words"] += wrd
-    stats["reactions"] += rct
-    stats["reacts_to_own"] += own
-    if sum([msg, cmd, wrd, rct, own]) != 0:
-      stats["change"] = True
+    if msg or cmd or wrd or rct or own:
+      self.get_user_stats(guild).adjust(id, msg, cmd, wrd, rct, own)
 
 
   async def on_reaction_add(self, reaction, user):
@@ -633,27 +689,48 @@ class BaseBot(commands.Bot):
   async def is_command(self, message):
     if not message.content: #ignore empty message
       return False
-    prefix = await self.find_prefix(message)
-    if prefix is not None:
-      if len(prefix) == 0: # no prefix is required
-        return True
-      prefix_match = re.match(f"({re.escape(prefix)}+)", message.content)
-      if prefix_match is not None: #command found
-        prefix_count = len(prefix_match.group(0))/len(prefix)
-        if prefix_count == 1: #bot commands should not increase words
-          return True
-        else: #multiple prefixes are not counted as a command
-          return False
-      else:
-        return False
-    return False
+    #bot commands should not increase words
+    return self.get_prefix_matcher(message.guild, await self.get_prefix(message)).is_command(message.content)
+
+  async def migrate_databases(self, guilds):
+    # creates the missing tables and applies the pending migrations
+    for guild in guilds:
+      self.create_tables(guild)
+    await self.migrations.migrate_all([self.db[guild.id] for guild in guilds])
+
+  def add_migration(self, version, description, apply):
+    self.migrations.add(version, description, apply)
+
+  def initialize_migrations(self):
+    def index_messages_and_media(db):
+      # indexes for the searches in the message archive and the media tracker
+      db.create_index("messages", "aid", "time")
+      db.create_index("messages", "cid", "time")
+      db.create_index("messages", "time")
+      db.create_index("media", "cid", "suppress", "pos", "time")
+      db.create_index("media", "time", "aid", "cid")
+      db.create_index("media", "aid", "time", "cid")
+    self.add_migration(1, "indexes of messages and media", index_messages_and_media)
+    def index_message_content(db):
+      # the full-text index for the keyword search of saved messages
+      db.create_fts("messages", "content")
+    self.add_migration(2, "full-text index of messages", index_message_content)
+    # the version 3 converted the files to incremental auto vacuum, the maintenance does it now in the quiet periods
+    def compact_settings(db):
+      # the default settings were stored in every guild database, only the changed ones are kept
+      Settings(db, self.default_settings).compact()
+    self.add_migration(4, "compaction of default settings", compact_settings)
 
   async def on_guild_join(self, guild):
+    await self.migrate_databases([guild])
     await self.init_bot(guild)
     await self.load_custom_commands(guild)
 
   async def on_ready(self):
+    # a new session can replace the guild objects
+    self.names.clear()
     self.initialize_default_settings()
+    await self.migrate_databases(self.guilds)
     for guild in self.guilds:
       await self.init_bot(guild)
     #Loading base extensions.
@@ -678,6 +755,8 @@ class BaseBot(commands.Bot):
         logger.exception(f"Could not load extension: {extension}")
 
   async def on_guild_remove(self, guild):
+    self.names.clear(guild.id)
+    self.prefix_matchers.pop(guild.id, None)
     logger.info(f"{self.user} has disconnected to: {guild.name} ({guild.id}).")
     
   async def delete_roles(self, guild):
@@ -751,6 +830,9 @@ class BaseBot(commands.Bot):
     
   def add_default_setting(self, defaultSetting):
     self.default_settings[defaultSetting.name] = defaultSetting
+    # the cached values were transformed without this setting
+    for settings in self.settings.values():
+      settings.values.pop(defaultSetting.name, None)
     
   def initialize_default_settings(self):
     bot_name = self.user.name
@@ -764,21 +846,23 @@ class BaseBot(commands.Bot):
     self.add_default_setting(DefaultSetting(name="MUTE_DURATION", default=1, description="mute expiry (day)", 
       transFun=lambda x: float(x), checkFun=lambda x: x>0, checkDescription="a positive number"))
     self.add_default_setting(DefaultSetting(name="MOD_ROLE_NAME", default=f"{bot_name}'s Enforcer", description="gives mod commands", 
-      adaptFun=self.change_bot_name_fun("MOD_ROLE_NAME")))
+      adaptFun=self.change_bot_name_fun("MOD_ROLE_NAME"), persist=True))
     self.add_default_setting(DefaultSetting(name="ADMIN_ROLE_NAME", default=f"{bot_name}'s Master", description="gives admin commands", 
-      adaptFun=self.change_bot_name_fun("ADMIN_ROLE_NAME")))
+      adaptFun=self.change_bot_name_fun("ADMIN_ROLE_NAME"), persist=True))
     self.add_default_setting(DefaultSetting(name="BOT_ROLE_NAME", default=f"{bot_name} Role", description="role the bot claims", 
-      adaptFun=self.change_bot_name_fun("BOT_ROLE_NAME")))
+      adaptFun=self.change_bot_name_fun("BOT_ROLE_NAME"), persist=True))
     self.add_default_setting(DefaultSetting(name="CMD_ROLE_NAME", default="Command Master", description="gives command editing access", 
       adaptFun=self.change_bot_name_fun("CMD_ROLE_NAME")))
     self.add_default_setting(DefaultSetting(name="MUTE_ROLE_NAME", default="Muted", description="revokes posting access", 
       adaptFun=self.change_bot_name_fun("MUTE_ROLE_NAME")))
     self.add_default_setting(DefaultSetting(name="BOT_CATEGORY_NAME", default=f"{bot_name}s-bot-corner", description="category for logs", 
-      adaptFun=self.change_bot_name_fun("BOT_CATEGORY_NAME")))
+      adaptFun=self.change_bot_name_fun("BOT_CATEGORY_NAME"), persist=True))
     self.add_default_setting(DefaultSetting(name="NUM_DELETE_CACHE", default=10, description="num of restorable deleted messages", 
       transFun=lambda x: int(x), checkFun=lambda x: x>=0, checkDescription="a non-negative integer"))
     self.add_default_setting(DefaultSetting(name="MODMAIL_EXPIRY", default=15.0, description="modmail expiry (min)", 
       transFun=lambda x: float(x), checkFun=lambda x: x>0, checkDescription="a positive number"))
+    self.add_default_setting(DefaultSetting(name="ARCHIVE_AGE", default=90.0, description="age of archived messages (day), 0 is off", 
+      transFun=lambda x: float(x), checkFun=lambda x: x>=0, checkDescription="a non-negative number"))
     self.add_default_setting(DefaultSetting(name="LEAVE_MSG", default=True, description="send message when user leaves ot not", 
       transFun=lambda x: str(x).lower() in ("yes", "true", "t", "1"), checkDescription="boolean"))
       
@@ -829,31 +913,39 @@ class BaseBot(commands.Bot):
     self.add_default_setting(DefaultSetting(name="MEDIA_ALERT_CD", default=10.0, description="cooldown of media alerts (min)", 
       transFun=lambda x: float(x), checkDescription="a number"))
   
-  def add_default_settings(self, guild):
-    #Add default settings for allowed settings
-    for key, setting in self.default_settings.items():
-      if key not in self.settings[guild.id]:
-        self.add_setting(guild, key, setting.default, setting.description)
-        
   async def reset_settings(self, context):
     guild = context.guild
     for key, setting in self.default_settings.items():
-      if key in self.settings[guild.id]:
-        current_setting = self.get_setting(guild, key)
-        if not current_setting == setting.default:
-          await self.set_setting(guild, key, setting.default, context)
-        self.add_setting_description(guild, key, setting.description)
-      else:
-        self.add_setting(guild, key, setting.default, setting.description)
+      current_setting = self.get_setting(guild, key)
+      if not current_setting == setting.default:
+        await self.set_setting(guild, key, setting.default, context)
+      # the settings with default value and description are deleted from the guild database
+      self.add_setting_description(guild, key, setting.description)
       
   async def close(self):
     if self.is_closed():
       return
+    for queue in self.log_queues.values():
+      try:
+        await queue.flush(timeout=5)
+      except Exception as e:
+        logger.error(f"{e.__class__.__name__} occurs when sending the logs to {queue.channel} ({queue.channel.id}): {e}")
     await super().close() # this method unloads all the cogs
     for guild in self.guilds:
-      self.update_user_stats(guild)
+      try:
+        await self.update_user_stats(guild)
+      except Exception as e:
+        logger.error(f"{e.__class__.__name__} occurs when saving the user statistics of guild {guild.id}: {e}")
+    for counters in self.user_stats.values():
+      counters.close()
     for k,db in self.db.items():
+      try:
+        db.flush()
+      except Exception as e:
+        logger.error(f"{e.__class__.__name__} occurs when flushing the database of guild {k}: {e}")
       db.close()
+    for archive in self.archives.values():
+      archive.close()
     logger.info("The bot client is completely closed.")
     
 def dynamic_prefix(bot, message):
@@ -0,0 +1,65 @@
+import shutil
+import tempfile
+import unittest
+from base.modules import db_manager
+from base.modules.db_manager import Database
+
+class QueryPlanTest(unittest.TestCase):
+  # The searches of the message and media tables have to use the indexes of migration 1 instead of scanning the table.
+  def setUp(self):
+    self.folder = tempfile.mkdtemp()
+    self.path = db_manager.path
+    db_manager.path = self.folder
+    self.db = Database(1)
+    # the tables of BaseBot.create_tables and the indexes of migration 1
+    self.db.create_table("messages", "mid", mid="int", time="real", aid="int", cid="int", content="txt", embeds="txt", files="txt")
+    self.db.create_table("media", "mid", mid="int", time="real", aid="int", cid="int", media="txt", pos="int", suppress="int")
+    self.db.create_index("messages", "aid", "time")
+    self.db.create_index("messages", "cid", "time")
+    self.db.create_index("messages", "time")
+    self.db.create_index("media", "cid", "suppress", "pos", "time")
+    self.db.create_index("media", "time", "aid", "cid")
+    self.db.create_index("media", "aid", "time", "cid")
+    # a month of messages in 40 channels by 500 users, the maintenance collects the statistics for the query planner
+    self.db.insert_many("messages", [(i, 1.6e9+i*120, i%500, i%40, f"message {i}", "[]", "[]") for i in range(20000)])
+    self.db.insert_many("media", [(i, 1.6e9+i*120, i%500, i%40, "[]", i%100, i%3-1) for i in range(20000)])
+    self.db.maintain(time_budget=10)
+
+  def tearDown(self):
+    self.db.close()
+    db_manager.path = self.path
+    shutil.rmtree(self.folder)
+
+  def assertSearch(self, query, table):
+    plan = self.db.explain(query)
+    self.assertTrue(any([line.startswith(f"SEARCH {table} USING") and "INDEX" in line for line in plan]), plan)
+    self.assertFalse(any([line.startswith(f"SCAN {table}") for line in plan]), plan)
+
+  def test_search_messages(self):
+    # MessageManagement._search_msg
+    self.assertSearch("SELECT * FROM messages WHERE aid IN (1, 2) ORDER BY time DESC LIMIT 10", "messages")
+    self.assertSearch("SELECT * FROM messages WHERE cid IN (3) AND length(files)>2 ORDER BY time DESC LIMIT 10", "messages")
+    self.assertSearch("SELECT * FROM messages WHERE aid IN (1) AND cid IN (3) ORDER BY ABS(1600000000.0-time) LIMIT 10", "messages")
+
+  def test_purge_messages(self):
+    # MessageManagement._purge_msg
+    self.assertSearch("SELECT COUNT(*) FROM messages WHERE aid IN (1) AND time<=1600000000.0", "messages")
+    self.assertSearch("SELECT COUNT(*) FROM messages WHERE cid IN (3, 4)", "messages")
+    self.assertSearch("DELETE FROM messages WHERE aid IN (1) AND cid IN (3)", "messages")
+    self.assertSearch("SELECT mid FROM messages WHERE time<1600000000.0 LIMIT 1", "messages")
+
+  def test_suppress_media(self):
+    # MediaManagement.suppress_message
+    self.assertSearch("WITH temp as (SELECT * FROM media WHERE cid=3 AND suppress>0) SELECT mid FROM temp "
+                      "WHERE (time<=1600000000.0) OR (pos>5 OR mid IN (SELECT mid from temp ORDER BY pos ASC LIMIT -1 OFFSET 10))", "media")
+    self.assertSearch("UPDATE media SET pos=pos+1 WHERE cid=3", "media")
+
+  def test_media_history(self):
+    # MediaManagement.get_media_history
+    self.assertSearch("SELECT aid, COUNT(mid) AS num FROM media WHERE time>1600000000.0 GROUP BY aid ORDER BY num DESC", "media")
+    self.assertSearch("SELECT COUNT(mid) AS num FROM media WHERE time>1600000000.0 and (aid=1 and cid=3) GROUP BY NULL ORDER BY num DESC", "media")
+    self.assertSearch("SELECT cid, COUNT(mid) AS num FROM media WHERE time>1600000000.0 and (aid=1) GROUP BY cid ORDER BY num DESC", "media")
+    self.assertSearch("SELECT aid, COUNT(mid) AS num FROM media WHERE time>1600000000.0 and (cid=3) GROUP BY aid ORDER BY num DESC", "media")
+
+if __name__ == "__main__":
+  unittest.main()